@@ -0,0 +1,56 @@
+"""
+    Times the two-loop and compact forms of the lbfgs step across problem
+    sizes, to find where the compact form starts to pay off. Also reports
+    the cost of appending a pair, which is higher for the compact form as
+    it maintains the inner products between the stored pairs.
+    
+    Run as: python benchmarks/lbfgs_step.py [max log10 n, default 7]
+"""
+
+import sys
+import time
+from numpy import *
+from phessianfree import innersolve
+
+def fill(memory, n, rs):
+    for i in range(memory.m + 2):
+        s = rs.randn(n)
+        y = s + 0.1*rs.randn(n)
+        memory.append(s, y, 1.0/dot(s, y))
+
+def time_per_call(fn, minTime=0.2):
+    calls = 0
+    start = time.time()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed > minTime:
+            return elapsed/calls
+
+def run(maxExponent=7, m=10):
+    rs = random.RandomState(0)
+    print "%10s %12s %12s %8s %12s %12s" % ("n", "twoloop", "compact", "ratio", 
+        "append", "append(c)")
+    for exponent in range(3, maxExponent+1):
+        n = 10**exponent
+        g = rs.randn(n)
+        
+        memory = innersolve.LbfgsMemory(m, n)
+        fill(memory, n, rs)
+        twoloop = time_per_call(lambda: innersolve.lbfgs_step(g, 1, memory, {}))
+        append = time_per_call(lambda: memory.append(g, g, 1.0))
+        
+        memory = innersolve.LbfgsMemory(m, n, compact=True)
+        fill(memory, n, rs)
+        compact = time_per_call(lambda: innersolve.lbfgs_step(g, 1, memory, {}))
+        appendCompact = time_per_call(lambda: memory.append(g, g, 1.0))
+        
+        print "%10d %12.2e %12.2e %8.2f %12.2e %12.2e" % (n, twoloop, compact, 
+            twoloop/compact, append, appendCompact)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        run()
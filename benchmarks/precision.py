@@ -0,0 +1,67 @@
+"""
+    Compares optimize runs storing gradients, curvature pairs and
+    hessian-vector products in float64 and float32 (the dtype property),
+    on the synthetic problems in problems.py. For each iteration it
+    reports the objective value and gradient norm under both, along with
+    the memory taken by the gradient cache and lbfgs memory.
+
+    The dense logistic problem is also run with its gaussNewtonProd hidden,
+    as finite difference products are the most sensitive to precision.
+
+    Run as: python benchmarks/precision.py [maxiter, default 20]
+"""
+
+import sys
+from numpy import *
+import phessianfree
+from phessianfree import objective
+import problems
+
+class FiniteDifference(object):
+    """ Hides the objective's gaussNewtonProd """
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, x, s, e):
+        return self.f(x, s, e)
+
+def trace(f, x0, ndata, dtype, maxiter):
+    rows = []
+    def callback(x, fval, g, pointsProcessed):
+        rows.append((fval, linalg.norm(g)))
+
+    phessianfree.optimize(f, x0, ndata, maxiter=maxiter, callback=callback,
+                          props={'dtype': dtype, 'seed': 0})
+    return rows
+
+def storageMB(ndata, n, dtype, props={}):
+    itemsize = dtype(0).itemsize
+    (psize, parts) = objective.partition(ndata, props.get('parts', 100))
+    pairs = 2*props.get('lbfgsMemory', 10)
+    return (parts + pairs)*n*itemsize/1e6
+
+def run(maxiter=20):
+    runs = [(name, name) for name in sorted(problems.problems)]
+    runs.append(('dense_logistic_fd', 'dense_logistic'))
+    for (label, name) in runs:
+        (f, x0, ndata) = problems.problems[name]()
+        if label.endswith('_fd'):
+            f = FiniteDifference(f)
+
+        print "%s: storage %.1f MB in float64, %.1f MB in float32" % (label,
+            storageMB(ndata, len(x0), float64), storageMB(ndata, len(x0), float32))
+        print "%5s %16s %16s %10s %10s %10s" % ("iter", "fval (64)", "fval (32)",
+            "rel diff", "gnorm (64)", "gnorm (32)")
+        double = trace(f, x0, ndata, float64, maxiter)
+        single = trace(f, x0, ndata, float32, maxiter)
+        for (k, ((f64, g64), (f32, g32))) in enumerate(zip(double, single)):
+            print "%5d %16.10f %16.10f %10.2e %10.2e %10.2e" % (k, f64, f32,
+                abs(f32 - f64)/abs(f64), g64, g32)
+        print
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        run()
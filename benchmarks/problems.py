@@ -0,0 +1,130 @@
+"""
+    Synthetic problems for the benchmarks. Each generator returns
+    (f, x0, ndata), with f following the objective conventions of
+    phessianfree.optimize.
+"""
+
+import scipy.sparse
+import scipy.special
+from numpy import *
+from phessianfree import glm
+
+def sparse_matrix(ndata, n, density, rs):
+    """ Random csr matrix, with entries placed independently (so a few 
+        may be summed together), avoiding scipy.sparse.random's 
+        O(ndata*n) memory use for large matrices.
+    """
+    nnz = int(ndata*n*density)
+    rows = rs.randint(0, ndata, nnz)
+    cols = rs.randint(0, n, nnz)
+    return scipy.sparse.csr_matrix((rs.randn(nnz), (rows, cols)), 
+                                   shape=(ndata, n))
+
+def dense_least_squares(ndata=20000, n=500, seed=0):
+    rs = random.RandomState(seed)
+    X = rs.randn(ndata, n)
+    d = dot(X, rs.randn(n)) + rs.randn(ndata)
+    return (glm.LeastSquaresObjective(X, d, 0.001), zeros(n), ndata)
+
+def sparse_least_squares(ndata=50000, n=20000, density=0.001, seed=0):
+    rs = random.RandomState(seed)
+    X = sparse_matrix(ndata, n, density, rs)
+    d = X.dot(rs.randn(n)) + rs.randn(ndata)
+    return (glm.LeastSquaresObjective(X, d, 0.001), zeros(n), ndata)
+
+def dense_logistic(ndata=20000, n=500, seed=0):
+    rs = random.RandomState(seed)
+    X = rs.randn(ndata, n)
+    d = sign(dot(X, rs.randn(n)) + rs.randn(ndata))
+    return (glm.LogisticObjective(X, d, 0.001), zeros(n), ndata)
+
+def sparse_logistic(ndata=50000, n=20000, density=0.001, seed=0):
+    rs = random.RandomState(seed)
+    X = sparse_matrix(ndata, n, density, rs)
+    d = sign(X.dot(rs.randn(n)) + 0.1*rs.randn(ndata))
+    return (glm.LogisticObjective(X, d, 0.001), zeros(n), ndata)
+
+class Autoencoder(object):
+    """
+        Single hidden layer sigmoid autoencoder with cross entropy loss,
+        as in examples/autoencoder_objective.py but written directly in
+        numpy, so the benchmarks don't need Theano.
+    """
+
+    def __init__(self, X, reg, n_hidden):
+        self.X = X
+        self.reg = reg
+        self.n = X.shape[0]
+        self.n_visible = X.shape[1]
+        self.n_hidden = n_hidden
+
+    def unwrap(self, w):
+        bend = self.n_hidden + self.n_visible
+        bhid = w[:self.n_hidden]
+        bvis = w[self.n_hidden:bend]
+        W = w[bend:].reshape((self.n_visible, self.n_hidden))
+        return (bhid, bvis, W)
+
+    def forward(self, w, X):
+        (bhid, bvis, W) = self.unwrap(w)
+        y = scipy.special.expit(dot(X, W) + bhid)
+        z = scipy.special.expit(dot(y, W.T) + bvis)
+        return (y, z)
+
+    def backward(self, w, X, y, dzinner):
+        """ Gradient with respect to w, given that with respect to the
+            output layer's input.
+        """
+        (bhid, bvis, W) = self.unwrap(w)
+        da = dot(dzinner, W) * y * (1 - y)
+        gW = dot(dzinner.T, y) + dot(X.T, da)
+        return concatenate([da.sum(axis=0), dzinner.sum(axis=0), gW.ravel()])
+
+    def __call__(self, w, s=0, e=None):
+        (loss, g, _) = self.evalCached(w, s, e)
+        return (loss, g)
+
+    def evalCached(self, w, s=0, e=None):
+        """ As __call__, but also returns the activations (y, z), which
+            the optimizer hands back to gaussNewtonProd.
+        """
+        if e is None:
+            e = self.n
+        X = self.X[s:e, :]
+        (y, z) = self.forward(w, X)
+
+        zc = clip(z, 1e-12, 1 - 1e-12)
+        loss = -sum(X*log(zc) + (1 - X)*log(1 - zc))
+        loss += 0.5*self.reg*(e-s)*dot(w, w)
+        g = self.backward(w, X, y, zc - X) + self.reg*(e-s)*w
+        return (loss/self.n, g/self.n, (y, z))
+
+    def gaussNewtonProd(self, w, v, s, e, cache=None):
+        X = self.X[s:e, :]
+        (bhid, bvis, W) = self.unwrap(w)
+        (vbhid, vbvis, VW) = self.unwrap(v)
+        if cache is None:
+            cache = self.forward(w, X)
+        (y, z) = cache
+
+        # Directional derivative of the output layer's input, then back
+        # through the same Jacobian after scaling by the loss curvature
+        dy = y * (1 - y) * (dot(X, VW) + vbhid)
+        Jv = dot(dy, W.T) + dot(y, VW.T) + vbvis
+        HJv = z * (1 - z) * Jv
+        return (self.backward(w, X, y, HJv) + self.reg*(e-s)*v)/self.n
+
+def autoencoder(ndata=5000, n_visible=100, n_hidden=20, seed=0):
+    rs = random.RandomState(seed)
+    X = (rs.rand(ndata, n_visible) < 0.3) * 1.0
+    f = Autoencoder(X, 0.0001, n_hidden)
+    x0 = 0.01*rs.randn(n_hidden + n_visible + n_visible*n_hidden)
+    return (f, x0, ndata)
+
+problems = {
+    'dense_least_squares': dense_least_squares,
+    'sparse_least_squares': sparse_least_squares,
+    'dense_logistic': dense_logistic,
+    'sparse_logistic': sparse_logistic,
+    'autoencoder': autoencoder,
+}
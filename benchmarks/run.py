@@ -0,0 +1,175 @@
+"""
+    Benchmark suite for phessianfree. Times optimize end to end on the
+    synthetic problems in problems.py, along with micro-benchmarks of
+    lbfgs_step, make_hv, SubsetObjective.__call__ and strong_wolfe.
+
+    For each benchmark it reports wall time, number of calls to the
+    objective, pointsProcessed and the peak resident memory of the process
+    running it. Each benchmark runs in its own forked process so peak
+    memory is not carried over between them.
+
+    Run as: python benchmarks/run.py [--output results.json] [--only name]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import time
+import numpy
+from numpy import *
+import phessianfree
+from phessianfree import objective, innersolve, linesearch
+import problems
+from lbfgs_step import fill, time_per_call
+
+class Counting(object):
+    """ Wraps an objective, counting the calls made to it """
+
+    def __init__(self, f):
+        self.f = f
+        self.calls = 0
+
+    def __call__(self, x, s, e):
+        self.calls += 1
+        return self.f(x, s, e)
+
+    def __getattr__(self, name):
+        attr = getattr(self.f, name)
+        if name == 'evalCached':
+            def counted(x, s, e):
+                self.calls += 1
+                return attr(x, s, e)
+            return counted
+        return attr
+
+def bench_optimize(problem, props, maxiter=10):
+    (f, x0, ndata) = problems.problems[problem]()
+    f = Counting(f)
+    props = dict(props, collectStats=True, seed=0)
+    pointsProcessed = [0]
+    def callback(x, fval, g, pp, stats):
+        pointsProcessed[0] = pp
+
+    start = time.time()
+    (x, fval, history) = phessianfree.optimize(f, x0, ndata, maxiter=maxiter,
+                                               callback=callback, props=props)
+    result = {'wall': time.time() - start, 'evaluations': f.calls,
+              'pointsProcessed': pointsProcessed[0], 'fval': fval, 
+              'iterations': len(history)}
+    for name in ['innerSolveTime', 'lineSearchTime', 'evaluationTime',
+                 'lineSearchEvaluations', 'innerSolveEvaluations', 
+                 'hessianProducts', 'curvatureRejections']:
+        result[name] = sum(getattr(stats, name) for stats in history)
+    return result
+
+def bench_lbfgs_step(n, m=10):
+    rs = random.RandomState(0)
+    g = rs.randn(n)
+    memory = innersolve.LbfgsMemory(m, n)
+    fill(memory, n, rs)
+    return {'wall': time_per_call(lambda: innersolve.lbfgs_step(g, 1, memory, {}))}
+
+def prepared(problem, props):
+    """ A SubsetObjective over the problem, with its subset evaluated at x0 """
+    (f, x0, ndata) = problems.problems[problem]()
+    f = Counting(f)
+    sobj = objective.SubsetObjective(f, ndata, len(x0), dict(props, seed=0))
+    (fval, g) = sobj(x0)
+    f.calls = 0
+    sobj.pointsProcessed = 0
+    return (f, sobj, x0, fval, g)
+
+def bench_make_hv(problem, finiteDifference, products=20):
+    (f, sobj, x0, fval, g) = prepared(problem, {})
+    if finiteDifference:
+        # Hide the objective's own product, forcing the FD fallback
+        sobj.f = lambda x, s, e: f(x, s, e)
+    v = random.RandomState(0).randn(len(x0))
+
+    start = time.time()
+    for i in range(products):
+        sobj.make_mv_rand(x0)(v)
+    return {'wall': (time.time() - start)/products, 'evaluations': f.calls,
+            'pointsProcessed': sobj.pointsProcessed}
+
+def bench_subset_call(problem, calls=5):
+    (f, sobj, x0, fval, g) = prepared(problem, {})
+    start = time.time()
+    for i in range(calls):
+        sobj.currentSubsetParts = 0
+        sobj(x0)
+    return {'wall': (time.time() - start)/calls, 'evaluations': f.calls,
+            'pointsProcessed': sobj.pointsProcessed,
+            'subsetParts': sobj.currentSubsetParts}
+
+def bench_strong_wolfe(problem):
+    (f, sobj, x0, fval, g) = prepared(problem, {})
+    pk = -g / linalg.norm(g, inf)
+    start = time.time()
+    (t, _, _) = linesearch.strong_wolfe(sobj, x0, fval, g, pk, {})
+    return {'wall': time.time() - start, 'evaluations': f.calls,
+            'pointsProcessed': sobj.pointsProcessed, 'step': t}
+
+benchmarks = [
+    ('optimize/dense_least_squares', bench_optimize, ('dense_least_squares', {})),
+    ('optimize/sparse_least_squares', bench_optimize, ('sparse_least_squares', {})),
+    ('optimize/dense_logistic', bench_optimize, ('dense_logistic', {})),
+    ('optimize/sparse_logistic', bench_optimize, ('sparse_logistic', {})),
+    ('optimize/dense_logistic_cg', bench_optimize, ('dense_logistic',
+        {'subsetVariant': 'cg', 'subsetObjective': False})),
+    ('optimize/autoencoder', bench_optimize, ('autoencoder', {})),
+    # No intermediates kept, for comparison with the cached activations
+    ('optimize/autoencoder_nocache', bench_optimize, ('autoencoder', 
+        {'cacheParts': 0})),
+    ('lbfgs_step/1e4', bench_lbfgs_step, (10**4,)),
+    ('lbfgs_step/1e6', bench_lbfgs_step, (10**6,)),
+    ('make_hv/dense_logistic_gn', bench_make_hv, ('dense_logistic', False)),
+    ('make_hv/dense_logistic_fd', bench_make_hv, ('dense_logistic', True)),
+    ('make_hv/sparse_logistic_gn', bench_make_hv, ('sparse_logistic', False)),
+    ('make_hv/autoencoder_gn', bench_make_hv, ('autoencoder', False)),
+    ('subset_call/dense_logistic', bench_subset_call, ('dense_logistic',)),
+    ('subset_call/sparse_logistic', bench_subset_call, ('sparse_logistic',)),
+    ('strong_wolfe/dense_logistic', bench_strong_wolfe, ('dense_logistic',)),
+    ('strong_wolfe/autoencoder', bench_strong_wolfe, ('autoencoder',)),
+]
+
+def run_one(args):
+    (name, fn, fnArgs) = args
+    result = fn(*fnArgs)
+    result['name'] = name
+    # Linux reports this in kilobytes
+    result['peakMemoryMB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    return result
+
+def run(only=None):
+    selected = [b for b in benchmarks if only is None or only in b[0]]
+    results = []
+    for bench in selected:
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(run_one, (bench,))
+        finally:
+            pool.terminate()
+        results.append(result)
+        print "%-36s %10.4fs %8s evals %12s points %8.1f MB" % (result['name'],
+            result['wall'], result.get('evaluations', '-'),
+            result.get('pointsProcessed', '-'), result['peakMemoryMB'])
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--only', help="only run benchmarks containing this")
+    args = parser.parse_args()
+
+    logging.basicConfig(level="WARNING")
+    results = run(args.only)
+    if args.output is not None:
+        with open(args.output, 'w') as out:
+            json.dump({'python': platform.python_version(),
+                       'numpy': numpy.__version__,
+                       'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                       'results': results}, out, indent=2, sort_keys=True)
@@ -0,0 +1,72 @@
+"""
+    Checks that the running-moment variance test in SubsetObjective.__call__
+    picks the same subset size as the original implementation, which
+    recomputed every part's deviation from the mean each time a part was 
+    added, and compares the time taken by the two.
+    
+    Run as: python benchmarks/subset_variance.py
+"""
+
+import time
+from numpy import *
+from phessianfree import objective
+
+def reference_subset_parts(losses, grads, currentSubsetParts, errBound):
+    """ The stopping rule as originally written, O(parts^2 n). """
+    parts = grads.shape[0]
+    loss = 0.0
+    g = zeros(grads.shape[1])
+    for p in range(parts):
+        loss += losses[p]
+        g += grads[p,:]
+        
+        if p >= currentSubsetParts:
+            gavg = g/(p+1)
+            gavgnorm = linalg.norm(gavg)
+            sumSq = 0.0
+            for j in range(p+1):
+                dev = linalg.norm(grads[j,:] - gavg)
+                sumSq += pow(dev/((p+1)*gavgnorm), 2.0)
+            errAvg = sqrt(sumSq)
+            
+            standardErr = errAvg * sqrt((parts-p-1.0)/(parts-1.0)) 
+            fraction = (p+1)/float(parts)
+            if (standardErr < errBound and 
+               fraction <= 0.8 and fraction >= 0.05 and p >= 4):
+                break
+    return p + 1
+
+class NoisyGradient(object):
+    """ Each datapoint contributes a fixed gradient plus gaussian noise. """
+    def __init__(self, ndata, n, noise, seed):
+        rs = random.RandomState(seed)
+        self.ndata = ndata
+        self.G = ones(n) + noise*rs.randn(ndata, n)
+        
+    def __call__(self, x, s, e):
+        return (float(e-s)/self.ndata, self.G[s:e,:].sum(axis=0)/self.ndata)
+
+def run(ndata=20000, n=2000, parts=400):
+    print "%8s %10s %10s %10s %10s" % ("noise", "parts", "reference", "eval+test", "ref test")
+    for (i, noise) in enumerate([1.0, 5.0, 10.0, 20.0, 40.0, 80.0]):
+        f = NoisyGradient(ndata, n, noise, seed=i)
+        props = {'parts': parts, 'gradRelErrorBound': 0.1}
+        sobj = objective.SubsetObjective(f, ndata, n, props)
+        x = zeros(n)
+        
+        start = time.time()
+        sobj(x)
+        elapsed = time.time() - start
+        
+        start = time.time()
+        expected = reference_subset_parts(sobj.losses, sobj.grads, 0, 
+                                          sobj.errBound)
+        refElapsed = time.time() - start
+        
+        print "%8.1f %10d %10d %10.3f %10.3f" % (noise, sobj.currentSubsetParts, 
+            expected, elapsed, refElapsed)
+        if sobj.currentSubsetParts != expected:
+            raise Exception("Stopping decisions differ")
+
+if __name__ == "__main__":
+    run()
@@ -9,14 +9,14 @@ import matplotlib.pyplot as plt
 import mnist
 import os, struct
 
-def permute_data(X, d):
+def permute_data(X, d, rs=random):
     perm = range(X.shape[0])
-    random.shuffle(perm)
+    rs.shuffle(perm)
     X = X[perm, :]
     d = d[perm]
     return (X,d)
     
-def read_mnist(partial=False):
+def read_mnist(partial=False, rs=random):
     logger = logging.getLogger("mnist")
     
     digits1 = [0,1,2,3,4]
@@ -39,12 +39,12 @@ def read_mnist(partial=False):
         C1 = [ k for k in xrange(len(labels)) if labels[k] in digits1 ]
         C2 = [ k for k in xrange(len(labels)) if labels[k] in digits2 ]
 
-        random.shuffle(C1)
-        random.shuffle(C2)
+        rs.shuffle(C1)
+        rs.shuffle(C2)
 
         # Extract the random subsets together as a data matrix X (1 row per datapoint)
         train = C1[:m1] + C2[:m2]
-        random.shuffle(train)
+        rs.shuffle(train)
         X = array(images[train,:])
         d = array([ 2*(k in digits1) - 1 for k in labels[train] ])
         return (X,d)
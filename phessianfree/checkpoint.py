@@ -0,0 +1,121 @@
+"""
+.. module:: checkpoint
+    :platform: Unix, Windows
+    :synopsis: Saving and restoring the state of optimize between iterations
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+
+When the **checkpoint** property is set, optimize saves its state to that
+file every **checkpointEvery** outer iterations, and a run can be
+continued from the file by passing it to optimize as **resume**. The state
+is the current point, value and gradient, the lbfgs memory, the
+objective's subset size and counters, the state of its random number
+generator (see the **seed** property) and any collected statistics, so
+the resumed run takes exactly the same steps as the original would have.
+
+Checkpoints are .npz files. The state is copied when it is saved, and
+written out on a background thread to a temporary file, which then
+replaces the previous checkpoint. The optimizer only waits if the
+previous write has not finished.
+"""
+
+import logging
+import os
+import threading
+import numpy
+from numpy import *
+from stats import IterationStats
+
+def save(filename, state):
+    """ Writes the dict of arrays state to filename, replacing it
+        atomically, so the file always holds a complete checkpoint.
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as out:
+        numpy.savez(out, **state)
+        out.flush()
+        os.fsync(out.fileno())
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+
+def load(filename):
+    """ Reads a checkpoint written by save, as a dict of arrays """
+    with open(filename, 'rb') as source:
+        archive = numpy.load(source)
+        return dict((key, archive[key]) for key in archive.files)
+
+def prefixed(prefix, state):
+    return dict((prefix + key, value) for (key, value) in state.items())
+
+def unprefixed(prefix, state):
+    return dict((key[len(prefix):], value) for (key, value) in state.items()
+                if key.startswith(prefix))
+
+def snapshot(k, xk, fval, gfk, memory, f, history):
+    """ The state of optimize after k iterations, as a dict of arrays """
+    state = {'k': k, 'xk': xk.copy(), 'fval': fval, 'gfk': gfk.copy()}
+    state.update(prefixed('memory.', memory.state()))
+    state.update(prefixed('objective.', f.state()))
+
+    (_, keys, pos, hasGauss, cachedGaussian) = f.random.get_state()
+    state.update({'random.keys': keys, 'random.pos': pos,
+                  'random.hasGauss': hasGauss,
+                  'random.cachedGaussian': cachedGaussian})
+
+    for name in IterationStats.fields:
+        state['stats.' + name] = array([getattr(s, name) for s in history])
+    return state
+
+def restore(state, memory, f):
+    """ Restores the lbfgs memory, objective and random state from a
+        snapshot, returning (k, xk, fval, gfk, history).
+    """
+    xk = state['xk'].copy()
+    memory.restore(unprefixed('memory.', state))
+    f.restore(unprefixed('objective.', state), xk)
+
+    f.random.set_state(('MT19937', state['random.keys'],
+                        int(state['random.pos']),
+                        int(state['random.hasGauss']),
+                        float(state['random.cachedGaussian'])))
+
+    history = []
+    for i in range(len(state['stats.iteration'])):
+        stats = IterationStats(int(state['stats.iteration'][i]))
+        for name in IterationStats.fields:
+            setattr(stats, name, state['stats.' + name][i].item())
+        history.append(stats)
+
+    return (int(state['k']), xk, float(state['fval']), state['gfk'].copy(),
+            history)
+
+class Writer(object):
+    """ Saves checkpoints to filename on a background thread, one at a
+        time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread = None
+        self.logger = logging.getLogger("phf.checkpoint")
+
+    def write(self, state):
+        """ Starts writing state, after any previous write completes. """
+        self.wait()
+        self.thread = threading.Thread(target=self.run, args=(state,))
+        self.thread.start()
+
+    def run(self, state):
+        try:
+            save(self.filename, state)
+            self.logger.debug("Checkpoint written to %s at iteration %d",
+                              self.filename, state['k'])
+        except Exception:
+            self.logger.exception("Writing checkpoint %s failed", self.filename)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
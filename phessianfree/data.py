@@ -0,0 +1,220 @@
+"""
+.. module:: data
+    :platform: Unix, Windows
+    :synopsis: Out-of-core data sources for objectives evaluated over ranges of datapoints
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+
+Objectives passed to :func:`phessianfree.optimize` only ever look at a
+contiguous range of datapoints (s,e) at a time, so the dataset does not
+need to be held in memory. The sources here can be used in place of
+an in-memory array inside an objective, as they support the same row slicing
+(e.g. X[s:e, :]). Each slice is a view onto a memory mapped file, so
+no copy is made. When readahead is on, each slice request also starts
+reading in the following range of rows on a background thread. Objectives
+evaluate parts in order, so this usually loads the next part while the
+current one is being evaluated.
+"""
+
+import bisect
+import logging
+import mmap
+import numbers
+import threading
+import Queue
+import numpy
+from numpy import *
+import objective
+
+def write_memmap(filename, X):
+    """ Writes X to a raw binary file, suitable for opening with
+        MemmapSource(filename, X.shape, X.dtype).
+    """
+    out = numpy.memmap(filename, dtype=X.dtype, mode='w+', shape=X.shape)
+    out[...] = X
+    out.flush()
+    del out
+
+def write_chunks(prefix, X, parts):
+    """ Writes the rows of X out as a sequence of .npy files, one per part,
+        using the same partitioning as Objective. Returns the list of
+        filenames, which can be passed to ChunkedSource.
+    """
+    ndata = X.shape[0]
+    (psize, parts) = objective.partition(ndata, parts)
+    filenames = []
+    for p in range(parts):
+        (s,e) = objective.part_range(p, psize, parts, ndata)
+        filename = "%s-%05d.npy" % (prefix, p)
+        numpy.save(filename, X[s:e, ...])
+        filenames.append(filename)
+    return filenames
+
+def touch(A):
+    """ Reads one value from each page spanned by the array A, so
+        the OS pages it in.
+    """
+    if A.size == 0:
+        return 0.0
+    flat = A.reshape(-1) if A.flags.c_contiguous else A.ravel()
+    stride = max(1, mmap.PAGESIZE // A.itemsize)
+    return float(flat[::stride].sum())
+
+class Readahead(object):
+    """ Background thread that pages in ranges of rows of a source,
+        one request at a time. Requests made while one is already queued
+        replace it, as only the most recent is likely to still be useful.
+        The thread runs until close is called.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.requests = Queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, s, e):
+        try:
+            self.requests.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            self.requests.put_nowait((s, e))
+        except Queue.Full:
+            pass
+
+    def close(self):
+        """ Stops the thread, after any request in progress """
+        try:
+            self.requests.get_nowait()
+        except Queue.Empty:
+            pass
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            (s, e) = request
+            self.source.prefetch(s, e)
+
+class DataSource(object):
+    """ Base class for the sources, providing row slicing on top of a
+        rows(s, e) method, and readahead of the next range of rows.
+        Single rows and slices are read without touching the rest of the
+        data, other indexing (such as lists of rows) reads the whole
+        dataset first.
+    """
+
+    def __init__(self, readahead=False):
+        self.logger = logging.getLogger("phf.data")
+        self.readahead = Readahead(self) if readahead else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        """ Stops the readahead thread, if any """
+        if self.readahead is not None:
+            self.readahead.close()
+            self.readahead = None
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            (rowKey, rest) = (key[0], key[1:])
+        else:
+            (rowKey, rest) = (key, ())
+
+        if isinstance(rowKey, numbers.Integral):
+            k = int(rowKey)
+            if k < 0:
+                k += self.shape[0]
+            if k < 0 or k >= self.shape[0]:
+                raise IndexError("row %d out of range for %d rows" % 
+                                 (rowKey, self.shape[0]))
+            row = self.view(k, k+1)[0]
+            return row[rest] if len(rest) > 0 else row
+        elif isinstance(rowKey, slice) and (rowKey.step is None or 
+                                            rowKey.step > 0):
+            (s, e, step) = rowKey.indices(self.shape[0])
+            rows = self.rows(s, max(s, e))
+            if step != 1:
+                rows = rows[::step]
+            if len(rest) > 0:
+                rows = rows[(slice(None),) + rest]
+            return rows
+        else:
+            return self.rows(0, self.shape[0])[key]
+
+    def rows(self, s, e):
+        """ Returns rows s up to e, triggering readahead of the following
+            rows if enabled.
+        """
+        A = self.view(s, e)
+        if self.readahead is not None and e < self.shape[0]:
+            self.readahead.request(e, min(e + (e-s), self.shape[0]))
+        return A
+
+    def prefetch(self, s, e):
+        """ Pages in rows s up to e, blocking until done. """
+        touch(self.view(s, e))
+
+class MemmapSource(DataSource):
+    """ A dataset stored as a single raw binary file (e.g. as written by
+        write_memmap), accessed through numpy.memmap.
+    """
+
+    def __init__(self, filename, shape, dtype=float64, offset=0,
+                 readahead=False):
+        self.data = numpy.memmap(filename, dtype=dtype, mode='r',
+                                 shape=shape, offset=offset)
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+        super(MemmapSource, self).__init__(readahead)
+
+    def view(self, s, e):
+        return self.data[s:e, ...]
+
+class ChunkedSource(DataSource):
+    """ A dataset split by rows over a sequence of .npy files, each
+        memory mapped. If the files line up with the parts used by the
+        optimizer (see write_chunks), every part is a zero copy view onto
+        a single file. Ranges spanning files are copied together.
+    """
+
+    def __init__(self, filenames, readahead=False):
+        self.chunks = [numpy.load(fname, mmap_mode='r') for fname in filenames]
+        self.starts = [0]
+        for chunk in self.chunks:
+            self.starts.append(self.starts[-1] + chunk.shape[0])
+
+        self.shape = (self.starts[-1],) + self.chunks[0].shape[1:]
+        self.dtype = self.chunks[0].dtype
+        self.copiedRanges = 0
+        super(ChunkedSource, self).__init__(readahead)
+
+    def view(self, s, e):
+        if e <= s:
+            return self.chunks[-1][0:0, ...]
+        c = bisect.bisect_right(self.starts, s) - 1
+        if c < len(self.chunks) and e <= self.starts[c+1]:
+            offset = self.starts[c]
+            return self.chunks[c][(s-offset):(e-offset), ...]
+
+        self.copiedRanges += 1
+        if self.copiedRanges == 1:
+            self.logger.warning("Range (%d, %d) spans several chunks and was " +
+                "copied, chunks should match the optimizer's parts", s, e)
+
+        pieces = []
+        while s < e:
+            offset = self.starts[c]
+            end = min(e, self.starts[c+1])
+            pieces.append(self.chunks[c][(s-offset):(end-offset), ...])
+            s = end
+            c += 1
+        return numpy.concatenate(pieces)
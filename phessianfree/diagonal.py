@@ -0,0 +1,64 @@
+"""
+.. module:: diagonal
+    :platform: Unix, Windows
+    :synopsis: Estimates of the diagonal of the hessian, maintained across iterations
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+
+When the **diagonal** property is set, optimize keeps an estimate of the
+diagonal of the hessian (or Gauss-Newton matrix) in the lbfgs memory,
+updated once per outer iteration on a randomly chosen part. It is used as
+the initial matrix of the lbfgs approximation in place of a scalar
+multiple of the identity, so badly scaled coordinates are accounted for
+from the first step, and as the 'jacobi' pcg preconditioner.
+
+If the objective has a gaussNewtonDiag(x, s, e) method, returning the
+diagonal over the datapoints (s,e), it is used directly. Otherwise the
+diagonal is estimated from **diagonalProbes** hessian-vector products
+against random sign vectors (Hutchinson's estimator), using
+make_hv_block, so objectives with gaussNewtonProdBlock handle all the
+probes in one call.
+"""
+
+import logging
+from numpy import *
+
+# Entries are kept at least this fraction of the median entry. A few 
+# probes give noisy estimates, which are close to zero for some coordinates
+# even where the curvature is not, and dividing by them gives huge steps.
+# The median is not moved by those outliers as the mean is.
+FLOOR = 1e-2
+
+def estimate(f, x, p, probes):
+    """ An estimate of the diagonal of the hessian over part p at x,
+        scaled to the whole dataset as in make_hv.
+    """
+    if f.hasDiagonal:
+        return f.diagonal(x, p).astype(float64)
+
+    V = sign(f.random.randn(f.n, probes))
+    V[V == 0] = 1.0
+    HV = f.make_hv_block(x, p)(V)
+    # The mean is unbiased, but may be negative for positive curvature 
+    return abs((V*HV).mean(axis=1))
+
+def update(f, xk, memory, props):
+    """ Updates the estimate held in memory.diagonal with one sampled part,
+        as an exponentially weighted average with the previous estimate.
+    """
+    logger = logging.getLogger("phf.diagonal")
+    probes = props.get("diagonalProbes", 10)
+    decay = props.get("diagonalDecay", 0.9)
+
+    d = estimate(f, xk, f.samplePart(), probes)
+    if memory.diagonal is not None:
+        d = decay*memory.diagonal + (1.0 - decay)*d
+
+    floor = FLOOR*median(abs(d))
+    if floor <= 0:
+        logger.debug("Diagonal estimate is zero, not used")
+        return
+    memory.diagonal = maximum(d, floor)
+    logger.debug("Diagonal estimate range [%1.2e, %1.2e]",
+                 memory.diagonal.min(), memory.diagonal.max())
@@ -0,0 +1,230 @@
+"""
+.. module:: distributed
+    :platform: Unix
+    :synopsis: Objectives evaluated by a pool of worker processes, each holding a shard of the data
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+
+For datasets too large for one process to hold, a DistributedObjective
+starts a number of worker processes, each of which owns a contiguous range
+of the parts used by the optimizer and loads only the datapoints in those
+parts. The current point x, hessian-vector product directions v and
+the per-part losses and gradients are passed through shared memory arrays,
+so only small control messages are pickled.
+
+Pass the objective to :func:`phessianfree.optimize` in place of **f**.
+Workers are started with fork, so this is only supported on Unix.
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.sharedctypes
+import traceback
+import numpy
+from numpy import *
+import objective
+
+def shared_zeros(shape, dtype=float64):
+    """ A zeroed array backed by shared memory, visible to
+        processes forked after its creation.
+    """
+    dtype = numpy.dtype(dtype)
+    size = int(prod(shape))
+    raw = multiprocessing.sharedctypes.RawArray('b', max(size, 1)*dtype.itemsize)
+    return numpy.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+class Worker(object):
+    """ Runs in each worker process, serving evaluation and hessian-vector
+        product requests for the parts it owns.
+    """
+
+    def __init__(self, master, factory, partRange):
+        self.master = master
+        self.partRange = partRange
+        (self.s0, self.e0) = partRange
+        self.f = factory(self.s0, self.e0)
+
+        # Intermediates from the last evaluation of each part, see evalCached
+        self.cache = {}
+
+    def local(self, p):
+        (s,e) = self.master.partRange(p)
+        return (s - self.s0, e - self.s0)
+
+    def evaluate(self, parts):
+        x = self.master.xShared
+        key = objective.fingerprint(x)
+        points = 0
+        for p in parts:
+            (s,e) = self.local(p)
+            (loss, g, intermediates) = objective.eval_range(self.f, x, s, e)
+            self.master.losses[p] = loss
+            self.master.grads[p, :] = g
+            if intermediates is not None:
+                self.cache[p] = (key, intermediates)
+            points += (e-s)
+        return points
+
+    def product(self, p, fdEps):
+        x = self.master.xShared
+        v = self.master.vShared
+        (s,e) = self.local(p)
+        if hasattr(self.f, 'gaussNewtonProd'):
+            kwargs = {}
+            if hasattr(self.f, 'evalCached'):
+                (key, intermediates) = self.cache.get(p, (None, None))
+                if key != objective.fingerprint(x):
+                    intermediates = None
+                kwargs['cache'] = intermediates
+            self.master.hvShared[:] = self.f.gaussNewtonProd(x, v, s, e, **kwargs)
+        else:
+            (_, left_grad) = self.f(x + fdEps*v, s, e)
+            self.master.hvShared[:] = (left_grad - self.master.grads[p, :]) / fdEps
+        return (e-s)
+
+    def serve(self, conn):
+        while True:
+            request = conn.recv()
+            if request[0] == 'stop':
+                return
+            try:
+                if request[0] == 'eval':
+                    conn.send(('ok', self.evaluate(request[1])))
+                elif request[0] == 'hv':
+                    conn.send(('ok', self.product(request[1], request[2])))
+                else:
+                    raise Exception("Unknown request %s" % request[0])
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+
+def _runWorker(master, factory, partRange, conn):
+    try:
+        worker = Worker(master, factory, partRange)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+    conn.send(('ok', 0))
+    worker.serve(conn)
+
+class DistributedObjective(objective.Objective):
+    """
+        An Objective whose parts are evaluated by worker processes.
+        Each worker owns a contiguous block of parts, and calls
+        factory(s, e) once at startup to build its objective over
+        datapoints s up to e. That objective is called as f(x, s, e) and
+        gaussNewtonProd(x, v, s, e) (if present) with s and e relative
+        to the start of the worker's block, so it only needs to
+        hold its own block of data, and should load only that block.
+
+        The losses and gradients returned by each worker's objective are
+        summed as they are, so they must be divided by the size of the
+        full dataset, ndata, not by the size of the block. An objective
+        that divides by its own number of datapoints gives a different,
+        wrongly weighted objective without raising any error. For the
+        objectives in :mod:`phessianfree.glm`, pass ndata through. For 
+        example, with the data saved in .npy files, each worker reads only
+        its own rows of them::
+
+            def factory(s, e):
+                X = numpy.array(numpy.load("X.npy", mmap_mode='r')[s:e])
+                d = numpy.array(numpy.load("d.npy", mmap_mode='r')[s:e])
+                return glm.LogisticObjective(X, d, reg, ndata=ndata)
+
+            f = distributed.DistributedObjective(factory, ndata, n)
+
+        The **workers** property sets the number of worker processes,
+        defaulting to the number of cpus. Use
+        :class:`DistributedSubsetObjective` to evaluate gradients on
+        adaptive subsets, as optimize does by default.
+    """
+
+    def __init__(self, factory, ndata, n, props={}):
+        super(DistributedObjective, self).__init__(None, ndata, n, props)
+        self.logger = logging.getLogger("phf.distributed")
+        if self.grads is None:
+            raise Exception("DistributedObjective requires the dense gradCache")
+        self.executor = None
+        self.batchSize = 1
+
+        self.xShared = shared_zeros(n)
+        self.vShared = shared_zeros(n)
+        self.hvShared = shared_zeros(n, self.dtype)
+
+        # Contiguous blocks of parts, one per worker
+        blocks = [b for b in array_split(arange(self.parts), self.workers)
+                  if len(b) > 0]
+        self.owner = zeros(self.parts, dtype=int)
+        self.conns = []
+        self.processes = []
+        for (w, block) in enumerate(blocks):
+            self.owner[block] = w
+            partRange = (self.partRange(block[0])[0], self.partRange(block[-1])[1])
+            (conn, workerConn) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_runWorker,
+                args=(self, factory, partRange, workerConn))
+            process.daemon = True
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+        self.logger.info("Started %d workers", len(self.processes))
+
+        for w in range(len(self.conns)):
+            self.reply(w)
+
+    def allocate(self, shape, dtype=float64):
+        # The workers write the losses and gradients directly
+        return shared_zeros(shape, dtype)
+
+    def reply(self, w):
+        (status, value) = self.conns[w].recv()
+        if status == 'error':
+            raise Exception("Worker %d failed:\n%s" % (w, value))
+        return value
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('stop',))
+            except IOError:
+                pass
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.processes = []
+
+    def evalPartsAt(self, x, parts, key=None, following=[]):
+        self.xShared[:] = x
+        byOwner = {}
+        for p in parts:
+            byOwner.setdefault(self.owner[p], []).append(p)
+
+        # All owners work at once, then the replies are collected
+        for (w, ownParts) in byOwner.items():
+            self.conns[w].send(('eval', ownParts))
+        for w in byOwner.keys():
+            self.pointsProcessed += self.reply(w)
+
+    def make_hv(self, x, p):
+        (s,e) = self.partRange(p)
+        fdEps = linalg.norm(self.grads[p, :], inf) * self.fdEps
+        scale = self.ndata / float(e-s)
+        w = self.owner[p]
+
+        def mv(v):
+            self.xShared[:] = x
+            self.vShared[:] = v
+            self.conns[w].send(('hv', p, fdEps))
+            self.hessianProducts += 1
+            self.pointsProcessed += self.reply(w)
+            return scale*self.hvShared
+        return mv
+
+class DistributedSubsetObjective(DistributedObjective, objective.SubsetObjective):
+    """
+        As DistributedObjective, with the gradient evaluated over an
+        adaptively chosen subset of the parts. Parts are added to the subset
+        one at a time, so only the full objective and the line search
+        over an existing subset are spread over several workers.
+    """
+    pass
@@ -0,0 +1,204 @@
+"""
+.. module:: glm
+    :platform: Unix, Windows
+    :synopsis: Logistic regression and least squares objectives, for dense or sparse data
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+
+These follow the objective conventions used by :func:`phessianfree.optimize`:
+calling the objective with (w, s, e) returns the loss and gradient
+over datapoints s up to e, divided by the total number of datapoints,
+and gaussNewtonProd gives exact hessian-vector products over the
+same range. The data matrix may be a dense array, any of the sources
+in :mod:`phessianfree.data`, or a scipy.sparse matrix, which is stored
+in csr format. Sparse data is never densified. Row ranges are taken as
+views onto the csr arrays, and all products go through sparse
+matrix-vector multiplication.
+
+LogisticObjective implements evalCached, so the optimizer keeps the
+margins dot(X, w) computed when evaluating each part, and hands them
+back to gaussNewtonProd for products at the same point (which is how the
+optimizer uses them), saving a matrix-vector product.
+
+All the objectives implement directional, giving the loss and its
+directional derivative from products with X alone, which the line search
+uses for trial points when the directionalLineSearch property is set,
+and gaussNewtonDiag, giving the exact diagonal of the hessian for the
+diagonal property.
+"""
+
+import logging
+import numpy
+import scipy.sparse
+import scipy.special
+from numpy import *
+
+def row_slice(X, s, e):
+    """ Rows s up to e of X. For csr matrices the result shares its data
+        and indices arrays with X, rather than copying them as
+        X[s:e, :] does.
+    """
+    if scipy.sparse.isspmatrix_csr(X):
+        (ps, pe) = (X.indptr[s], X.indptr[e])
+        # The (data, indices, indptr) constructor copies slices of larger
+        # arrays, so the arrays are set directly instead.
+        Xs = scipy.sparse.csr_matrix((e-s, X.shape[1]), dtype=X.dtype)
+        Xs.data = X.data[ps:pe]
+        Xs.indices = X.indices[ps:pe]
+        Xs.indptr = X.indptr[s:(e+1)] - ps
+        Xs.has_sorted_indices = X.has_sorted_indices
+        return Xs
+    else:
+        return X[s:e, :]
+
+def tmul(X, r):
+    """ X transpose times r, for dense or sparse X """
+    if scipy.sparse.issparse(X):
+        return X.T.dot(r)
+    else:
+        return dot(X.T, r)
+
+class GLMObjective(object):
+    """
+        Common parts of the objectives in this module, which are all of
+        the form sum_i loss(dot(x_i, w), d_i) + 0.5*reg*ndata*||w||^2.
+        Subclasses give the loss and its first derivative with respect to
+        dot(x_i, w) through lossAndDerivative, and the second derivative
+        through curvature, which may return None if it is constant 1.
+        Both are functions of the margins dot(x_i, w).
+    """
+
+    def __init__(self, X, d, reg, ndata=None):
+        """
+            :param X: The dataset stacked as row vectors into a matrix,
+                either dense or scipy.sparse.
+            :param d: A vector of targets, one per datapoint.
+            :param reg: The regulization coefficient. the regulization term is
+                of the form 0.5*reg*||w||^2.
+            :param ndata: The number of datapoints the objective is divided
+                by, defaulting to the rows of X. Set this to the size of the 
+                full dataset when X is a shard of it, as for a
+                :class:`~phessianfree.distributed.DistributedObjective`.
+        """
+        if scipy.sparse.issparse(X):
+            csr = scipy.sparse.csr_matrix(X)
+            if not csr.has_sorted_indices:
+                # A csr X shares its arrays with csr, and is not modified
+                if scipy.sparse.isspmatrix_csr(X):
+                    csr = csr.copy()
+                csr.sort_indices()
+            X = csr
+        self.X = X
+        self.d = asarray(d)
+        self.reg = reg
+        self.n = X.shape[0] #datapoints
+        self.m = X.shape[1] # dimension
+        self.ndata = ndata if ndata is not None else self.n
+        self.logger = logging.getLogger("phf.glm")
+
+    def __call__(self, w, s=0, e=None):
+        (loss, g, _) = self.evaluate(w, s, e)
+        return (loss, g)
+    
+    def evaluate(self, w, s=0, e=None):
+        """ As __call__, but also returns the margins dot(X[s:e], w) """
+        if e is None:
+            e = self.n
+        X = row_slice(self.X, s, e)
+        d = self.d[s:e]
+
+        Y = X.dot(w)
+        (loss, dloss) = self.lossAndDerivative(Y, d)
+
+        loss += 0.5*self.reg*(e-s)*dot(w,w)
+        g = tmul(X, dloss) + self.reg*(e-s)*w
+
+        return (loss/self.ndata, g/self.ndata, Y)
+
+    def prefetch(self, s, e):
+        """ Pages in datapoints s up to e, when X is one of the sources in
+            :mod:`phessianfree.data`. Called ahead of evaluation when the 
+            **prefetchDepth** property is set.
+        """
+        if hasattr(self.X, 'prefetch'):
+            self.X.prefetch(s, e)
+
+    def directional(self, w, p, s, e):
+        """ The loss over datapoints s up to e, and its directional 
+            derivative along p, without forming the gradient.
+        """
+        X = row_slice(self.X, s, e)
+        (loss, dloss) = self.lossAndDerivative(X.dot(w), self.d[s:e])
+
+        loss += 0.5*self.reg*(e-s)*dot(w,w)
+        dd = dot(dloss, X.dot(p)) + self.reg*(e-s)*dot(w,p)
+        return (loss/self.ndata, dd/self.ndata)
+
+    def gaussNewtonProd(self, w, v, s, e, cache=None):
+        X = row_slice(self.X, s, e)
+        D = self.curvature(X, w, s, e, cache)
+
+        Xv = X.dot(v)
+        if D is not None:
+            Xv *= D
+        Hv = tmul(X, Xv) + self.reg*(e-s)*v
+        return Hv/self.ndata
+
+    def gaussNewtonDiag(self, w, s, e, cache=None):
+        """ The diagonal of the hessian over datapoints s up to e """
+        X = row_slice(self.X, s, e)
+        D = self.curvature(X, w, s, e, cache)
+        if D is None:
+            D = ones(e-s)
+
+        if scipy.sparse.issparse(X):
+            diag = tmul(X.multiply(X), D)
+        else:
+            diag = dot(D, X*X)
+        return (asarray(diag).ravel() + self.reg*(e-s))/self.ndata
+
+    def gaussNewtonProdBlock(self, w, V, s, e, cache=None):
+        X = row_slice(self.X, s, e)
+        D = self.curvature(X, w, s, e, cache)
+
+        XV = X.dot(V)
+        if D is not None:
+            XV *= D[:, newaxis]
+        HV = tmul(X, XV) + self.reg*(e-s)*V
+        return HV/self.ndata
+
+class LogisticObjective(GLMObjective):
+    """
+        Logistic regression objective function, with class labels d
+        either -1 or 1.
+    """
+
+    def lossAndDerivative(self, Y, d):
+        dY = d*Y
+        loss = sum(logaddexp(0, -dY))
+        return (loss, -d*scipy.special.expit(-dY))
+    
+    def evalCached(self, w, s, e):
+        # The margins are cached by the optimizer, for use in curvature
+        return self.evaluate(w, s, e)
+
+    def curvature(self, X, w, s, e, margins=None):
+        if margins is None:
+            margins = X.dot(w)
+        sigma = scipy.special.expit(self.d[s:e]*margins)
+        return sigma*(1.0 - sigma)
+
+class LeastSquaresObjective(GLMObjective):
+    """
+        Least squares objective function, 0.5*||Xw - d||^2 plus the
+        regulization term.
+    """
+
+    def lossAndDerivative(self, Y, d):
+        r = Y - d
+        return (0.5*dot(r, r), r)
+
+    def curvature(self, X, w, s, e, margins=None):
+        # The hessian of the loss is the identity for every datapoint
+        return None
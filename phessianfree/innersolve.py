@@ -2,33 +2,221 @@
 import logging
 import numpy
 from numpy import *
+import scipy.linalg
 import scipy.sparse
 import scipy.sparse.linalg
+import linesearch
 
-def max_key(vecs):
-    if len(vecs) == 0:
-        return 0
-    else:
-        return numpy.max(vecs.keys())+1
+class LbfgsMemory(object):
+    """ Holds the most recent m curvature pairs (s, y) and their 
+        rho = 1/dot(s,y), in preallocated m x n arrays used as a circular 
+        buffer. Once full, appending a pair overwrites the oldest one.
+        
+        If compact is set, the inner products between the stored pairs
+        are also maintained, as needed by lbfgs_step_compact.
+        
+        diagonal holds an estimate of the diagonal of the hessian when one
+        is maintained (see the diagonal module), used as the initial 
+        matrix of the lbfgs approximation.
+        
+        lastDirection holds the search direction returned by the last cg 
+        or pcg solve, used as their starting point when cgWarmStart is set.
+        
+        The pairs are stored with the given dtype, but rho and all inner
+        products involving them are computed in float64.
+    """
+    
+    def __init__(self, m, n, compact=False, dtype=float64):
+        self.m = m
+        self.S = zeros((m, n), dtype=dtype)
+        self.Y = zeros((m, n), dtype=dtype)
+        self.rho = zeros(m)
+        self.start = 0 # Slot holding the oldest pair
+        self.count = 0
+        self.rejections = 0 # Pairs not stored due to bad curvature
+        self.diagonal = None
+        self.lastDirection = None
+        
+        self.compact = compact
+        if compact:
+            self.SY = zeros((m, m)) # SY[i,j] = dot(S[i], Y[j])
+            self.YY = zeros((m, m))
+        
+    def __len__(self):
+        return self.count
+        
+    def append(self, s, y, rho):
+        if self.count < self.m:
+            i = (self.start + self.count) % self.m
+            self.count += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.m
+        self.S[i, :] = s
+        self.Y[i, :] = y
+        self.rho[i] = rho
+        
+        if self.compact:
+            self.SY[i, :] = rowdots(self.Y, self.S[i])
+            self.SY[:, i] = rowdots(self.S, self.Y[i])
+            self.YY[i, :] = rowdots(self.Y, self.Y[i])
+            self.YY[:, i] = self.YY[i, :]
+        
+    def state(self):
+        """ Copies of the arrays and counters, keyed by name, for 
+            checkpointing.
+        """
+        state = {'S': self.S.copy(), 'Y': self.Y.copy(), 'rho': self.rho.copy(),
+                 'start': self.start, 'count': self.count, 
+                 'rejections': self.rejections}
+        if self.compact:
+            state['SY'] = self.SY.copy()
+            state['YY'] = self.YY.copy()
+        if self.diagonal is not None:
+            state['diagonal'] = self.diagonal.copy()
+        if self.lastDirection is not None:
+            state['lastDirection'] = self.lastDirection.copy()
+        return state
+        
+    def restore(self, state):
+        """ Restores a state returned by the state method """
+        if state['S'].shape != self.S.shape:
+            raise Exception("Checkpointed lbfgs memory has shape %s, not %s" %
+                            (state['S'].shape, self.S.shape))
+        self.S[...] = state['S']
+        self.Y[...] = state['Y']
+        self.rho[...] = state['rho']
+        self.start = int(state['start'])
+        self.count = int(state['count'])
+        self.rejections = int(state['rejections'])
+        if 'diagonal' in state:
+            self.diagonal = state['diagonal'].copy()
+        if 'lastDirection' in state:
+            self.lastDirection = state['lastDirection'].copy()
+        if self.compact:
+            if 'SY' in state:
+                self.SY[...] = state['SY']
+                self.YY[...] = state['YY']
+            else:
+                for i in self.slots():
+                    self.SY[i, :] = rowdots(self.Y, self.S[i])
+                    self.YY[i, :] = rowdots(self.Y, self.Y[i])
+                
+    def slots(self):
+        """ Buffer slots in order from the oldest pair to the newest """
+        return [(self.start + j) % self.m for j in range(self.count)]
 
-def solve(f, xk, gfk, k, vecs, props):
+def rowdots(A, v):
+    """ dot(A, v), accumulated in float64 even if A and v are stored in 
+        lower precision. Rows are converted one at a time, so no float64 
+        copy of A is made.
+    """
+    if A.dtype == float64 and v.dtype == float64:
+        return dot(A, v)
+    v = v.astype(float64, copy=False)
+    return array([dot(a.astype(float64), v) for a in A])
+
+def rowsum(c, A):
+    """ dot(c, A), the combination of the rows of A with coefficients c,
+        accumulated in float64 as in rowdots.
+    """
+    if A.dtype == float64:
+        return dot(c, A)
+    r = zeros(A.shape[1])
+    for (ci, a) in zip(c, A):
+        r += ci*a
+    return r
+
+def solve(f, xk, gfk, k, memory, props):
+    logger = logging.getLogger("phf.innersolve")
     subsetVariant = props.get("subsetVariant", 'lbfgs')
     ###### Compute search direction
     if subsetVariant == 'lbfgs':
         searchFunc = lbfgs
     elif subsetVariant == 'cg':
         searchFunc = cg
+    elif subsetVariant == 'pcg':
+        searchFunc = pcg
     else:
         raise Exception("invalid linear solver variant configured")
         
-    return searchFunc(f, xk, gfk, k, vecs, props)
+    pk = searchFunc(f, xk, gfk, k, memory, props)
     
+    # A poor diagonal estimate may give a step that is not a descent 
+    # direction, in which case the plain lbfgs step is used instead.
+    if memory.diagonal is not None and dot(pk, gfk) >= 0:
+        logger.info("Step using the diagonal estimate is not a descent "
+                    "direction, using the plain lbfgs step")
+        pk = lbfgs_step(gfk, k, memory, props, useDiagonal=False)
+        if memory.lastDirection is not None:
+            memory.lastDirection = pk
+    return pk
+    
+    
+def cg_start(gfk, k, memory, props):
+    """ The starting point of cg and pcg. This is the lbfgs step, unless 
+        cgWarmStart is set, in which case it is the previous search 
+        direction scaled by cgWarmStart.
+    """
+    decay = props.get("cgWarmStart", 0.0)
+    if decay > 0 and memory.lastDirection is not None:
+        return decay*memory.lastDirection
+    return lbfgs_step(gfk, k, memory, props)
+
+class Iterates(object):
+    """ Keeps copies of the cg iterates at geometrically spaced 
+        iterations, ceil(1.3^j), for backtracking, when cgBacktrack is set.
+    """
     
-def cg(f, xk, gfk, k, vecs, props):
+    def __init__(self, props):
+        self.enabled = props.get("cgBacktrack", False)
+        self.kept = []
+        self.next = 1.0
+        self.i = 0
+        
+    def add(self, x):
+        """ Records the iterate after another cg step """
+        self.i += 1
+        if self.enabled and self.i >= ceil(self.next):
+            self.kept.append(x.copy())
+            while ceil(self.next) <= self.i:
+                self.next *= 1.3
+                
+    def best(self, f, xk, final, props):
+        """ Returns the final iterate, or if backtracking, the kept 
+            iterate with the lowest objective value on the current subset.
+            Iterates are evaluated from the last backwards, stopping once 
+            the value increases (Martens 2010). The cached gradients at xk
+            are restored afterwards, as the evaluations overwrite them.
+        """
+        if not self.enabled:
+            return final
+        logger = logging.getLogger("phf.innersolve")
+        candidates = self.kept + [final]
+        saved = f.saveCache()
+        
+        best = len(candidates) - 1
+        bestVal = linesearch.trial(f, xk + final, final, props)[0]
+        for j in reversed(range(len(candidates) - 1)):
+            if array_equal(candidates[j], candidates[best]):
+                continue
+            val = linesearch.trial(f, xk + candidates[j], candidates[j], 
+                                   props)[0]
+            if val < bestVal:
+                (best, bestVal) = (j, val)
+            else:
+                break
+        f.restoreCache(saved)
+        logger.debug("Backtracked to iterate %d of %d kept", best+1, 
+                     len(candidates))
+        return candidates[best]
+
+def cg(f, xk, gfk, k, memory, props):
     logger = logging.getLogger("phf.innersolve")
     solve_fraction = props.get("solveFraction", 0.2)
     n = len(xk)
-    x0 = lbfgs_step(gfk, k, vecs, props)
+    x0 = cg_start(gfk, k, memory, props)
+    iterates = Iterates(props)
     
     mv = f.make_mv_rand(xk)
     maxiter = int(ceil(solve_fraction*f.parts))
@@ -36,20 +224,108 @@ def cg(f, xk, gfk, k, vecs, props):
     mulOp = scipy.sparse.linalg.LinearOperator((n,n), matvec=mv, dtype=xk.dtype)
 
     def callback(v):
+        iterates.add(v)
         logger.debug("v: %s", v[0:min(5, n)])
 
     (pk, cginfo) = scipy.sparse.linalg.cg(mulOp, -gfk, x0=x0, tol=1e-10, 
                                           maxiter=maxiter, callback=callback)
 
+    pk = iterates.best(f, xk, pk, props)
+    memory.lastDirection = pk
     return pk
     
-def lbfgs(f, xk, gfk, k, vecs, props):
+def preconditioner(k, memory, props):
+    """ The preconditioner used by pcg, as a function applying it to a
+        residual. 'lbfgs' applies the lbfgs approximation to the inverse 
+        hessian, 'jacobi' the inverse of the diagonal estimate, and 'none'
+        the identity. Both of the first two fall back to the identity 
+        before there is anything to build them from.
+    """
+    kind = props.get("pcgPreconditioner", 'lbfgs')
+    if kind == 'lbfgs' and (k > 0 and len(memory) > 0 or 
+                            memory.diagonal is not None):
+        return lambda r: -lbfgs_step(r, max(k, 1), memory, props)
+    elif kind == 'jacobi' and memory.diagonal is not None:
+        return lambda r: r / memory.diagonal
+    elif kind in ('lbfgs', 'jacobi', 'none'):
+        return lambda r: r
+    else:
+        raise Exception("invalid pcg preconditioner configured")
+
+def pcg(f, xk, gfk, k, memory, props):
+    """
+        Preconditioned conjugate gradient on Hp = -g, over one part as in 
+        cg, starting from the lbfgs step. It stops once the residual is 
+        below pcgTol relative to the gradient, or when the quadratic model
+        q(p) = 0.5 p'Hp + g'p stops making progress (Martens 2010): after 
+        i steps, with j = max(10, 0.1 i), when 
+        (q_i - q_{i-j})/q_i < j*pcgProgressTol. It also stops if negative 
+        curvature is encountered.
+    """
+    logger = logging.getLogger("phf.innersolve")
+    solve_fraction = props.get("solveFraction", 0.2)
+    tol = props.get("pcgTol", 1e-10)
+    progressTol = props.get("pcgProgressTol", 5e-4)
+    n = len(xk)
+    
+    # The initial product counts towards the budget
+    maxiter = int(ceil(solve_fraction*f.parts))
+    precondition = preconditioner(k, memory, props)
+    mv = f.make_mv_rand(xk)
+    
+    x = cg_start(gfk, k, memory, props)
+    iterates = Iterates(props)
+    r = -gfk - mv(x)
+    z = precondition(r)
+    d = z.copy()
+    rz = dot(r, z)
+    gnorm = linalg.norm(gfk)
+    
+    # q(x) = 0.5 x'(g - r) as Hx = -g - r
+    qs = [0.5*dot(x, gfk - r)]
+    
+    for i in range(1, maxiter):
+        if linalg.norm(r) <= tol*gnorm:
+            logger.debug("pcg converged after %d steps", i-1)
+            break
+        
+        Hd = mv(d)
+        dHd = dot(d, Hd)
+        if dHd <= 0:
+            logger.debug("pcg stopped on non-positive curvature %1.1e", dHd)
+            break
+        
+        alpha = rz / dHd
+        x = x + alpha*d
+        r = r - alpha*Hd
+        iterates.add(x)
+        
+        q = 0.5*dot(x, gfk - r)
+        qs.append(q)
+        j = max(10, int(0.1*i))
+        if (progressTol > 0 and i >= j and q < 0 and 
+            (q - qs[i-j])/q < j*progressTol):
+            logger.debug("pcg stopped on slow progress after %d steps", i)
+            break
+        
+        z = precondition(r)
+        rzNew = dot(r, z)
+        d = z + (rzNew/rz)*d
+        rz = rzNew
+        
+        logger.debug("x: %s", x[0:min(5, n)])
+    
+    x = iterates.best(f, xk, x, props)
+    memory.lastDirection = x
+    return x
+
+def lbfgs(f, xk, gfk, k, memory, props):
     logger = logging.getLogger("phf.innersolve")
     solve_fraction = props.get("solveFraction", 0.2)
     stepFactor = props.get("innerSolveStepFactor", 0.5)
     average = props.get("innerSolveAverage", False)
     n = len(xk)
-    w = lbfgs_step(gfk, k, vecs, props)
+    w = lbfgs_step(gfk, k, memory, props)
     wsum = zeros(n)
     wsum_count = 0
     gnorm = linalg.norm(gfk)
@@ -66,7 +342,7 @@ def lbfgs(f, xk, gfk, k, vecs, props):
         Hw = mv(w)
         ri = Hw + gfk
         
-        pk = -lbfgs_step(ri, k+i, vecs, props)
+        pk = -lbfgs_step(ri, k+i, memory, props)
 
         mpk = mv(pk)
         Hpk = mpk
@@ -75,17 +351,17 @@ def lbfgs(f, xk, gfk, k, vecs, props):
         wHw = dot(w, Hw)
         
         ###### Update quasi-newton approximation
-        kmax = max_key(vecs)
         if pkHpk < 0:
             raise Exception("Hessian is not positive semi-definite. " + 
                             "Try using the Gauss-Newton approximation to the hessian." + 
                             "If your problem is convex, your gradient " +       
                             "calculation may just be wrong")
         else:
-            vecs[kmax] = (pk, Hpk, 1.0 / numpy.dot(pk,Hpk))
-            kmax = kmax + 1
+            memory.append(pk, Hpk, 1.0 / numpy.dot(pk,Hpk))
             if wHw > 0:
-                vecs[kmax] = (w, Hw, 1.0 / numpy.dot(w,Hw))
+                memory.append(w, Hw, 1.0 / numpy.dot(w,Hw))
+            else:
+                memory.rejections += 1
     
         wp = w - sst*pk
         
@@ -111,33 +387,80 @@ def lbfgs(f, xk, gfk, k, vecs, props):
         return w
         
 
-def lbfgs_step(gfk, k, vecs, props):
-    m = props.get("lbfgsMemory", 10)
+def lbfgs_step(gfk, k, memory, props, useDiagonal=True):
     q = gfk
-    a = {}
+    diagonal = memory.diagonal if useDiagonal else None
 
-    if k == 0:
+    if k == 0 or len(memory) == 0:
+        if diagonal is not None:
+            return -gfk / diagonal
         return -gfk / linalg.norm(gfk, numpy.inf)
     
-    k = numpy.max(vecs.keys())+1
+    # The compact form assumes a scalar initial matrix
+    if memory.compact and diagonal is None:
+        return lbfgs_step_compact(gfk, memory)
+    
+    S = memory.S
+    Y = memory.Y
+    rho = memory.rho
+    slots = memory.slots()
+    a = zeros(memory.m)
+    
+    for i in reversed(slots):
+        a[i] = rho[i] * numpy.dot(S[i], q)
+        q = q - a[i]*Y[i]
+    
+    if diagonal is not None:
+        r = q / diagonal
+    else:
+        newest = slots[-1]
+        sNewest = S[newest].astype(float64, copy=False)
+        yNewest = Y[newest].astype(float64, copy=False)
+        gammak = numpy.dot(sNewest, yNewest)/(numpy.dot(yNewest, yNewest))
+        r = gammak * q
+    
+    for i in slots:
+        beta = rho[i] * numpy.dot(Y[i], r)
+        r = r + S[i]*(a[i]-beta)
     
-    bl = max(0, k-m)
+    return -r
+
+def lbfgs_step_compact(gfk, memory):
+    """
+        The same step as the two-loop recursion in lbfgs_step, computed 
+        using the compact representation of the lbfgs matrix 
+        (Byrd, Nocedal & Schnabel 1994). The history enters through 
+        two matrix-vector products against the stacked S and Y arrays,
+        and a small triangular solve, instead of 2m separate dot products 
+        and vector updates.
+    """
+    slots = memory.slots()
+    order = array(slots)
     
-    for i in range(k-1, bl-1, -1):
-        (sk, yk, rhok) = vecs[i]
+    # Until the buffer wraps, the stored pairs are exactly the first 
+    # count rows, otherwise all rows are in use.
+    S = memory.S[:memory.count]
+    Y = memory.Y[:memory.count]
     
-        a[i] = rhok * numpy.dot(sk, q)
-        q = q - a[i]*yk
+    # Rows of these are in the buffer's slot order, reorder oldest first
+    a = rowdots(S, gfk)[order]
+    b = rowdots(Y, gfk)[order]
+    SY = memory.SY[ix_(order, order)]
+    YY = memory.YY[ix_(order, order)]
     
-    (sk, yk, rhok) = vecs[k-1]
-    gammak = numpy.dot(sk,yk)/(numpy.dot(yk,yk))
+    R = triu(SY)
+    D = diag(SY)
+    gammak = SY[-1, -1]/YY[-1, -1]
     
-    r = gammak * q
+    # H g = gammak g + S u - gammak Y r, where
+    # r = R^-1 S'g and u = R^-T ((D + gammak Y'Y) r - gammak Y'g)
+    r = scipy.linalg.solve_triangular(R, a)
+    u = scipy.linalg.solve_triangular(R, D*r + gammak*dot(YY, r) - gammak*b, 
+                                      trans='T')
     
-    for i in range(bl, k):
-        (sk, yk, rhok) = vecs[i]
-        
-        beta = rhok * numpy.dot(yk, r)
-        r = r + sk*(a[i]-beta)
+    cS = zeros(memory.count)
+    cY = zeros(memory.count)
+    cS[order] = u
+    cY[order] = -gammak*r
     
-    return -r
+    return -(gammak*gfk + rowsum(cS, S) + rowsum(cY, Y))
@@ -2,6 +2,48 @@
 import logging
 from numpy import *
 
+def evaluate(f, x):
+    """ Evaluates a trial point. Subset objectives are evaluated on the
+        current subset only, so the subset does not change during the 
+        search.
+    """
+    if hasattr(f, 'onCurrentSubset'):
+        return f.onCurrentSubset(x)
+    else:
+        return f(x)
+
+def trial(f, x, pk, props):
+    """ Evaluates a trial point, returning (cval, cdd, cgrad), where cdd is
+        the directional derivative along pk. If the directionalLineSearch 
+        property is set and the objective implements directional, only the
+        value and directional derivative are computed, and cgrad is None.
+    """
+    if props.get("directionalLineSearch", False) and getattr(f, 'hasDirectional', False):
+        if hasattr(f, 'directionalOnCurrentSubset'):
+            (cval, cdd) = f.directionalOnCurrentSubset(x, pk)
+        else:
+            (cval, cdd) = f.directional(x, pk)
+        return (cval, cdd, None)
+    else:
+        (cval, cgrad) = evaluate(f, x)
+        return (cval, dot(cgrad, pk), cgrad)
+
+def accept(f, x, cval, cgrad, expand=True):
+    """ Returns the value and gradient at the accepted point x, given its
+        trial evaluation (cval, cgrad). The gradient is computed if the 
+        trial only gave the directional derivative. If expand is set, 
+        subset objectives are expanded at x until the gradient error bound
+        holds. The sums over the current subset are kept from the trial 
+        evaluation when it computed the gradient, so only parts beyond it 
+        are evaluated.
+    """
+    if expand and hasattr(f, 'onCurrentSubset'):
+        return f(x, expand=True)
+    elif cgrad is None:
+        return evaluate(f, x)
+    else:
+        return (cval, cgrad)
+
 def weak_wolfe(f, xk, upper_val, grad, pk, props):
     logger = logging.getLogger("phf.ls")
     maxIter = props.get("maxLineSearchIter", 8)
@@ -13,25 +55,18 @@ def weak_wolfe(f, xk, upper_val, grad, pk, props):
     c2 = 0.9 #0.9
     cgrad = None
     
-    bracket_left_values = (upper_val, grad)
+    directional_derivative = dot(pk, grad)
+    bracket_left_values = (upper_val, directional_derivative)
     bracket_right_values = None
     bracket_left = 0.0
     bracket_right = inf
         
-    def phi(alpha):
-        if hasattr(f, 'onCurrentSubset'):
-            return f.onCurrentSubset(xk + alpha*pk)
-        else:
-            return f(xk + alpha*pk)
-
-    
-    directional_derivative = dot(pk, grad)
-        
     if directional_derivative > 0:
         raise Exception("Not a descent direction")
 
     for i in range(maxIter):
-        (cval, cgrad) = phi(t)
+        xt = xk + t*pk
+        (cval, cdd, cgrad) = trial(f, xt, pk, props)
         
         if isinf(cval) or isnan(cval):
             logger.debug("Encountered %1.1f", cval)
@@ -42,32 +77,30 @@ def weak_wolfe(f, xk, upper_val, grad, pk, props):
             logger.debug(" Armijo condition failed cval=%1.5f. Need: %1.5f < %1.5f",
                          cval, cval, upper_val + t*c1*directional_derivative)
             bracket_right = t
-            bracket_right_values = (cval, cgrad)
+            bracket_right_values = (cval, cdd)
             
             smallest_so_far = (t, cval, cgrad)
-        elif useWolfe and dot(cgrad, pk) < c2*directional_derivative:
+        elif useWolfe and cdd < c2*directional_derivative:
             # Weak wolfe condition fails
-            if abs(dot(cgrad, pk)) < 1e-5:
+            if abs(cdd) < 1e-5:
                 logger.debug(" Wolfe condition failed cval=%1.5f. Need %1.1e > %1.1e", 
-                         cval, dot(cgrad, pk), c2*directional_derivative)
+                         cval, cdd, c2*directional_derivative)
             else:
                 logger.debug(" Wolfe condition failed cval=%1.5f. Need %1.5f > %1.5f (dd at t=0: %1.5f)", 
-                         cval, dot(cgrad, pk), 
+                         cval, cdd, 
                          c2*directional_derivative, directional_derivative)
             
                 
             bracket_left = t
-            bracket_left_values = (cval, cgrad)
+            bracket_left_values = (cval, cdd)
 
         else:
             break
                 
         oldt = t
         if bracket_right < inf:
-            (lval, lgrad) = bracket_left_values
-            (rval, rgrad) = bracket_right_values
-            ldd = dot(lgrad, pk)
-            rdd = dot(rgrad, pk)
+            (lval, ldd) = bracket_left_values
+            (rval, rdd) = bracket_right_values
             
             if rdd < 0 or ldd > 0:
                 logger.error("directional derivatives suggest step outside valley:" + 
@@ -111,8 +144,7 @@ def weak_wolfe(f, xk, upper_val, grad, pk, props):
         raise Exception("Line search failed")
         #(t, cval, cgrad) = smallest_so_far
            
-    if hasattr(f, 'onCurrentSubset'):
-        (cval, cgrad) = f(xk + t*pk, expand=True)
+    (cval, cgrad) = accept(f, xt, cval, cgrad)
            
     return (t, cval, cgrad)
     
@@ -123,22 +155,28 @@ def strong_wolfe(f, xk, upper_val, grad, pk, props):
     maxIter = props.get("maxLineSearchIter", 8)
     interpMethod = props.get("lsInterpMethod", 'cubic')
     t = props.get("initialLineSearcht", 1.0)
+    expandSubset = props.get("expandSubset", False)
     
     c1 = 1e-4
     c2 = 0.9
     cgrad = None
     
+    dd = dot(pk, grad)
     last_t = 0
     last_val = upper_val
-    last_grad = grad
+    last_dd = dd
+    
+    # The last trial point, so an accepted one is not recomputed
+    current = {}
     
     def phi(alpha):
-        if hasattr(f, 'onCurrentSubset'):
-            return f.onCurrentSubset(xk + alpha*pk)
-        else:
-            return f(xk + alpha*pk)
+        current['x'] = xk + alpha*pk
+        return trial(f, current['x'], pk, props)
+    
+    def done(t, cval, cgrad):
+        (cval, cgrad) = accept(f, current['x'], cval, cgrad, expandSubset)
+        return (t, cval, cgrad)
        
-    dd = dot(pk, grad)
     logger.info("Last fval: %1.5f, dd: %1.5f", upper_val, dd)
 
     def interp(lt, ldd, lval, rt, rdd, rval):
@@ -163,14 +201,11 @@ def strong_wolfe(f, xk, upper_val, grad, pk, props):
             t = (lt+rt)/2
         return t
 
-    def zoom(lt, lval, lgrad, rt, rval, rgrad):
+    def zoom(lt, lval, ldd, rt, rval, rdd):
         olt = lt
         ort = rt
         t = rt
 
-            
-        ldd = dot(lgrad, pk)
-        rdd = dot(rgrad, pk)
         for i in range(maxIter):
             #logger.debug("Finding interp between %1.1e, and %1.1e", lt, rt)
             if lt > rt:
@@ -179,8 +214,7 @@ def strong_wolfe(f, xk, upper_val, grad, pk, props):
                 t = interp(lt, ldd, lval, rt, rdd, rval)
             #logger.debug("Choose %1.4e", t)
             
-            (cval, cgrad) = phi(t)
-            tdd = dot(cgrad, pk)
+            (cval, tdd, cgrad) = phi(t)
             logger.info("cval: %1.5f, tdd: %1.4e, t=%1.1e [lt: %1.1e, rt: %1.1e]", 
                         cval, tdd, t, lt, rt)
             if cval > upper_val + c1*t*dd or cval >= lval:
@@ -188,22 +222,22 @@ def strong_wolfe(f, xk, upper_val, grad, pk, props):
                 #    cval,  upper_val + c1*t*dd, lval)
                 #logger.debug("ZOOM: reducing RHS bracket to t")
                 rval = cval
-                rgrad = cgrad
+                rdd = tdd
                 rt = t
             else:
                 if abs(tdd) <= -c2*dd:
-                    return (t, cval, cgrad)
+                    return done(t, cval, cgrad)
                 if tdd*(rt - lt) >= 0:
                     #logger.debug("ZOOM: Setting RHS of bracket to LHS")
                     rval = lval
-                    rgrad = lgrad
+                    rdd = ldd
                     rt = lt
                     
                 #logger.debug("ZOOM: wolfe failed, want %1.4e <= %1.4e",
                 #            abs(tdd), -c2*dd)
                 
                 lval = cval
-                lgrad = cgrad
+                ldd = tdd
                 lt = t
         raise Exception("Line search failed")   
         
@@ -212,8 +246,7 @@ def strong_wolfe(f, xk, upper_val, grad, pk, props):
         raise Exception("Not a descent direction")
 
     for i in range(maxIter):
-        (cval, cgrad) = phi(t)
-        tdd = dot(cgrad, pk)
+        (cval, tdd, cgrad) = phi(t)
         
         logger.info("cval: %1.5f, tdd: %1.4e, t=%1.1e", cval, tdd, t)
         if isinf(cval) or isnan(cval):
@@ -223,20 +256,67 @@ def strong_wolfe(f, xk, upper_val, grad, pk, props):
             
         if cval > upper_val + c1*t*dd or (cval >= last_val and i > 0):
             #logger.debug("Zooming on Armijo condion failure")
-            return zoom(last_t, last_val, last_grad, t, cval, cgrad)
+            return zoom(last_t, last_val, last_dd, t, cval, tdd)
             
         if abs(tdd) <= -c2*dd:
             logger.debug("Strong wolfe satisfied without zooming")
-            return (t, cval, cgrad)
+            return done(t, cval, cgrad)
             
         if tdd >= 0:
             #logger.debug("tdd positive, zooming on inverted range")
-            return zoom(t, cval, cgrad, last_t, last_val, last_grad)
+            return zoom(t, cval, tdd, last_t, last_val, last_dd)
             
         last_t = t
         last_val = cval
-        last_grad = cgrad
+        last_dd = tdd
         t *= 1.5
         logger.debug("Armijo but not strong Wolfe. Increased t to: %1.1e", t)
         
     raise Exception("Line search failed")
+
+def damped_step(f, xk, upper_val, grad, pk, props):
+    """
+        Alternative to a line search, for the damping step control. The 
+        full step pk is tried with a single evaluation, and accepted only 
+        if it decreases the objective. The damping f.damping, added to the
+        hessian-vector products used to find pk, is then adapted from the 
+        ratio of the actual reduction to that predicted by the undamped 
+        quadratic model, measured on one sampled part (Martens 2010). 
+        Returns (t, cval, cgrad) as the line searches do, with t = 0 and 
+        the values at xk if the step is rejected. The trial evaluation
+        overwrites the cached gradients at xk, which the hessian-vector 
+        products of the next inner solve use, so they are saved first and 
+        put back on rejection.
+    """
+    logger = logging.getLogger("phf.ls")
+    increase = props.get("dampingIncrease", 1.5)
+    decrease = props.get("dampingDecrease", 2.0/3.0)
+    
+    # Undamped model reduction q(pk) - q(0) = g'p + 0.5 p'Hp
+    Hp = f.make_hv(xk, f.samplePart())(pk)
+    predicted = dot(grad, pk) + 0.5*dot(pk, Hp)
+    
+    saved = f.saveCache()
+    xt = xk + pk
+    (cval, cdd, cgrad) = trial(f, xt, pk, props)
+    
+    if isinf(cval) or isnan(cval) or predicted >= 0:
+        ratio = -inf
+    else:
+        ratio = (cval - upper_val)/predicted
+    
+    if ratio < 0.25:
+        f.damping *= increase
+    elif ratio > 0.75:
+        f.damping *= decrease
+    logger.info("Damped step: cval %1.5f, reduction ratio %1.2f, damping now %1.2e",
+                cval, ratio, f.damping)
+    
+    if cval < upper_val:
+        (cval, cgrad) = accept(f, xt, cval, cgrad, 
+                               props.get("expandSubset", False))
+        return (1.0, cval, cgrad)
+    else:
+        logger.info("Damped step rejected")
+        f.restoreCache(saved)
+        return (0.0, upper_val, grad)
@@ -1,9 +1,212 @@
 
+import collections
+import hashlib
 import logging
 import pickle
+import time
+import threading
+import Queue
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.sharedctypes
+import numpy
 import scipy
 from numpy import *
 
+# For the process executor, the objective is handed to each worker once
+# when the pool is created, rather than being pickled along with every part.
+# The point x (and direction d) are written to shared memory before each
+# batch of parts, so only the part ranges are sent to the workers.
+_workerObjective = None
+_workerX = None
+_workerD = None
+
+def _initWorker(f, sharedX, sharedD):
+    global _workerObjective, _workerX, _workerD
+    _workerObjective = f
+    _workerX = numpy.frombuffer(sharedX, dtype=float64)
+    _workerD = numpy.frombuffer(sharedD, dtype=float64)
+
+def _evalInWorker(args):
+    (s, e) = args
+    return eval_range(_workerObjective, _workerX.copy(), s, e)
+
+def _directionalInWorker(args):
+    (s, e) = args
+    return _workerObjective.directional(_workerX.copy(), _workerD.copy(), s, e)
+
+def eval_range(f, x, s, e):
+    """ Evaluates f over the range (s,e), returning (loss, g, intermediates),
+        where intermediates is None unless f implements evalCached.
+    """
+    if hasattr(f, 'evalCached'):
+        return f.evalCached(x, s, e)
+    else:
+        (loss, g) = f(x, s, e)
+        return (loss, g, None)
+
+def fingerprint(x):
+    """ A digest of the contents of the array x, used to check whether
+        values cached during an earlier evaluation are for the same point.
+    """
+    x = ascontiguousarray(x)
+    return (x.shape, x.dtype.str, hashlib.md5(x).digest())
+
+def partition(ndata, parts):
+    """ Returns (psize, parts), the size of each part and the number
+        of parts used when splitting ndata points into roughly the given 
+        number of parts. The last part takes up any remainder.
+    """
+    psize = int(ceil(ndata / float(parts)))
+    # Number of parts is adjusted downwards if necessary for even partitioning
+    parts = int(floor(ndata / float(psize)))
+    return (psize, parts)
+
+def part_range(p, psize, parts, ndata):
+    # Last part is handled differently
+    if p == parts - 1:
+        return (p*psize, ndata)
+    else:
+        return (p*psize, (p+1)*psize)
+
+def random_state(seed):
+    """ The RandomState used for sampling, given the seed property. This 
+        is numpy's global random state if seed is None, and seed itself if 
+        it is already a RandomState.
+    """
+    if seed is None:
+        return numpy.random
+    if isinstance(seed, numpy.random.RandomState):
+        return seed
+    return numpy.random.RandomState(seed)
+
+class PartCache(object):
+    """ Holds the intermediates returned by evalCached for the most
+        recently evaluated parts, along with a fingerprint of the point
+        they were evaluated at. Once more than capacity parts are held,
+        the least recently used is dropped.
+    """
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        
+    def put(self, p, key, intermediates):
+        self.entries.pop(p, None)
+        self.entries[p] = (key, intermediates)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            
+    def get(self, p, key):
+        """ The intermediates for part p, if they were computed at 
+            the point with fingerprint key, otherwise None.
+        """
+        entry = self.entries.pop(p, None)
+        if entry is None:
+            return None
+        self.entries[p] = entry
+        if entry[0] == key:
+            return entry[1]
+        else:
+            return None
+
+class Prefetcher(object):
+    """ Stages the data of upcoming parts on a background thread, by 
+        calling f.prefetch(s, e), so it overlaps the evaluation of the
+        current part. Requests are served in the order made. Time spent 
+        prefetching, and time the evaluation spent waiting for a part's
+        prefetch to finish, are both recorded, their difference being 
+        the overlap achieved. The thread is started by the first request
+        and runs until stop is called.
+    """
+    
+    def __init__(self, f, depth):
+        self.f = f
+        self.depth = depth
+        self.logger = logging.getLogger("phf.objective")
+        self.issued = {} # Part -> Event set once its prefetch finishes
+        self.time = 0.0
+        self.waitTime = 0.0
+        self.requests = Queue.Queue()
+        self.thread = None
+        
+    def request(self, p, s, e):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        if p not in self.issued:
+            self.issued[p] = threading.Event()
+            self.requests.put((s, e, self.issued[p]))
+            
+    def wait(self, p):
+        """ Waits for any prefetch of part p to finish """
+        event = self.issued.pop(p, None)
+        if event is not None and not event.is_set():
+            start = time.time()
+            event.wait()
+            self.waitTime += time.time() - start
+    
+    def clear(self):
+        """ Forgets the parts requested but never waited for, at the end 
+            of a sequence of evaluations that stopped before reaching them.
+            Their data may no longer be staged by the time they are next 
+            evaluated, so they are requested again then.
+        """
+        self.issued = {}
+    
+    def stop(self):
+        """ Stops the thread, once the requests already made are served """
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+        self.issued = {}
+    
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            (s, e, event) = request
+            start = time.time()
+            try:
+                self.f.prefetch(s, e)
+            except Exception:
+                self.logger.exception("Prefetch of (%d, %d) failed", s, e)
+            self.time += time.time() - start
+            event.set()
+
+class RunningSums(object):
+    """ Sums of the losses and gradients of the parts added so far, 
+        along with the running mean and sum of squared deviations 
+        (Welford) of the part gradients, so each added part costs O(n).
+    """
+    
+    def __init__(self, n):
+        self.count = 0
+        self.loss = 0.0
+        self.g = zeros(n)
+        self.gmean = zeros(n)
+        self.devSumSq = 0.0
+        
+    def add(self, loss, g):
+        self.count += 1
+        self.loss += loss
+        self.g += g
+        delta = g - self.gmean
+        self.gmean += delta/float(self.count)
+        self.devSumSq += dot(delta, g - self.gmean)
+        
+    def copy(self):
+        c = RunningSums(0)
+        c.count = self.count
+        c.loss = self.loss
+        c.g = self.g.copy()
+        c.gmean = self.gmean.copy()
+        c.devSumSq = self.devSumSq
+        return c
+
 class Objective(object):
 
     def __init__(self, f, ndata, n, props={}):
@@ -13,55 +216,371 @@ class Objective(object):
         self.ndata = ndata
         self.f = f
         self.pointsProcessed = 0
+        
+        # Source of all random choices made by the optimizer
+        self.random = random_state(props.get('seed', None))
+        
+        # Counters for IterationStats. Time is only measured if asked for.
+        self.evaluations = 0
+        self.hessianProducts = 0
+        self.evaluationTime = 0.0
+        self.timed = props.get('collectStats', False)
 
         # parts, we make the last part larger than the rest 
         # if ndata is not exactly divisble        
-        self.parts = props.get('parts', 100)
-        self.psize = int(ceil(ndata / float(self.parts)))
+        (self.psize, self.parts) = partition(ndata, props.get('parts', 100))
         self.logger.info("Part size %d chosen for m-v products", self.psize)
-        # Number of parts is adjusted downwards if necessary for even partitioning
-        self.parts = int(floor(ndata / float(self.psize)))
         
-        self.losses = zeros(self.parts)
-        self.grads = zeros((self.parts, self.n))
+        # Cached gradients may be kept in reduced precision to save memory,
+        # they are accumulated into float64 vectors when reduced.
+        self.dtype = dtype(props.get('dtype', float64))
+        self.losses = self.allocate(self.parts)
+        
+        # Finite differences against a reduced precision gradient need a 
+        # larger step, around the square root of its machine epsilon.
+        if self.dtype == float64:
+            self.fdEps = props.get("fdEps", 1e-8)
+        else:
+            self.fdEps = props.get("fdEps", sqrt(finfo(self.dtype).eps))
+        
+        # Optional concurrent evaluation of parts
+        self.executor = props.get('parallel', None)
+        if self.executor not in (None, 'thread', 'process'):
+            raise Exception("invalid parallel executor configured")
+        self.workers = props.get('workers', multiprocessing.cpu_count())
+        self.batchSize = self.workers if self.executor is not None else 1
+        self.workerPool = None
+        
+        # Either the gradient of every part is kept, in a dense parts x n 
+        # array, or only those of the most recently evaluated parts are.
+        self.gradCache = props.get('gradCache', 'dense')
+        if self.gradCache == 'dense':
+            self.grads = self.allocate((self.parts, self.n), self.dtype)
+        elif self.gradCache == 'lru':
+            self.grads = None
+            self.recentGrads = PartCache(max(props.get('gradCacheParts', 10), 
+                                             self.batchSize))
+        else:
+            raise Exception("invalid gradCache configured")
+        
+        # Levenberg-Marquardt damping added to the hessian-vector products
+        # used by the inner solves, see linesearch.damped_step
+        self.damping = 0.0
+        
+        # Data for upcoming parts may be staged while the current part is
+        # evaluated
+        self.prefetcher = None
+        if props.get('prefetchDepth', 0) > 0 and hasattr(f, 'prefetch'):
+            self.prefetcher = Prefetcher(f, props['prefetchDepth'])
+        
+        # Values and directional derivatives alone, for line search trials
+        self.hasDirectional = hasattr(f, 'directional')
+        
+        # Exact diagonals of the Gauss-Newton matrix, see the diagonal module
+        self.hasDiagonal = hasattr(f, 'gaussNewtonDiag')
+        
+        # Intermediates kept from evaluations, for use by gaussNewtonProd
+        self.cacheIntermediates = hasattr(f, 'evalCached')
+        if self.cacheIntermediates:
+            self.partCache = PartCache(props.get('cacheParts', self.parts))
+
+    def allocate(self, shape, dtype=float64):
+        """ A zeroed array for the cached losses or gradients. Subclasses
+            may override this to place them elsewhere, such as in shared 
+            memory.
+        """
+        return zeros(shape, dtype=dtype)
 
     def evalRange(self, x, s, e):
         self.pointsProcessed += (e-s)
         return self.f(x, s, e)
 
     def partRange(self, p):
-        # Last part is handled differently
-        if p == self.parts - 1:
-            return (p*self.psize, self.ndata)
-        else:
-            return (p*self.psize, (p+1)*self.psize)
+        return part_range(p, self.psize, self.parts, self.ndata)
 
-    def evalPart(self, x, p):
+    def evalPart(self, x, p, key=None):
         """ Caches the gradient for this part for later use in hessian
-            vector products.
+            vector products. key is the fingerprint of x, if already known.
         """
         (s,e) = self.partRange(p)
-        (loss, g) = self.evalRange(x, s, e)
-        self.losses[p] = loss
-        self.grads[p, :] = g
+        self.pointsProcessed += (e-s)
+        (loss, g, intermediates) = eval_range(self.f, x, s, e)
+        self.storePart(x, p, loss, g, intermediates, key)
         return (loss, g)
+    
+    def storePart(self, x, p, loss, g, intermediates, key=None):
+        self.losses[p] = loss
+        if key is None and (intermediates is not None or self.grads is None):
+            key = fingerprint(x)
+        if self.grads is not None:
+            self.grads[p, :] = g
+        else:
+            self.recentGrads.put(p, key, asarray(g).astype(self.dtype))
+        if intermediates is not None:
+            self.partCache.put(p, key, intermediates)
+
+    def pointKey(self, x):
+        """ The fingerprint of x, if any cache in use is keyed by point, 
+            otherwise None, so x is not hashed needlessly.
+        """
+        if self.cacheIntermediates or self.grads is None:
+            return fingerprint(x)
+        return None
+
+    def partGrad(self, x, p, key=None):
+        """ The gradient of part p at x. With the dense gradient cache this
+            is whatever was last stored for part p, which is assumed to be 
+            at x. Otherwise it is only reused if it was stored for the 
+            point x, and part p is evaluated again if not.
+        """
+        if self.grads is not None:
+            return self.grads[p, :]
+        if key is None:
+            key = fingerprint(x)
+        g = self.recentGrads.get(p, key)
+        if g is None:
+            self.evalPart(x, p, key)
+            g = self.recentGrads.get(p, key)
+        return g
+
+    def batches(self, parts):
+        """ Splits parts into the batches that are evaluated before their
+            gradients are reduced. This is a single batch when all part 
+            gradients are kept, otherwise a batch per worker, so each 
+            batch fits in the recently evaluated gradients.
+        """
+        parts = list(parts)
+        if self.grads is not None:
+            size = max(len(parts), 1)
+        else:
+            size = self.batchSize
+        return [parts[i:i+size] for i in range(0, len(parts), size)]
+
+    def pool(self):
+        """ Lazily starts the worker pool, if one is configured. """
+        if self.executor is None:
+            return None
+        if self.workerPool is None:
+            self.logger.info("Starting %s pool with %d workers", 
+                             self.executor, self.workers)
+            if self.executor == 'thread':
+                self.workerPool = multiprocessing.pool.ThreadPool(self.workers)
+            else:
+                sharedX = multiprocessing.sharedctypes.RawArray('d', self.n)
+                sharedD = multiprocessing.sharedctypes.RawArray('d', self.n)
+                self.sharedX = numpy.frombuffer(sharedX, dtype=float64)
+                self.sharedD = numpy.frombuffer(sharedD, dtype=float64)
+                self.workerPool = multiprocessing.Pool(self.workers, 
+                    initializer=_initWorker, initargs=(self.f, sharedX, sharedD))
+        return self.workerPool
+    
+    def close(self):
+        if self.workerPool is not None:
+            self.workerPool.terminate()
+            self.workerPool = None
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+
+    def evalParts(self, x, parts, key=None, following=()):
+        """ Evaluates each of the given parts at x, caching the results 
+            in self.losses and the gradient cache. With a parallel executor
+            the parts are evaluated concurrently, but results are always 
+            written back in order, and pointsProcessed is only updated 
+            from the calling thread. key is the fingerprint of x, if 
+            already known. following lists the parts expected to be 
+            evaluated next, which are prefetched if enabled.
+        """
+        if self.timed:
+            start = time.time()
+            self.evalPartsAt(x, list(parts), key, list(following))
+            self.evaluationTime += time.time() - start
+        else:
+            self.evalPartsAt(x, list(parts), key, list(following))
+    
+    def prefetchAhead(self, upcoming):
+        """ Requests prefetching of the first of the upcoming parts, up
+            to the prefetch depth.
+        """
+        for q in upcoming[:self.prefetcher.depth]:
+            (s,e) = self.partRange(q)
+            self.prefetcher.request(q, s, e)
+    
+    def prefetchDone(self):
+        """ Ends a sequence of evaluations made with evalParts, which may
+            have prefetched parts past the last one it evaluated.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.clear()
+    
+    def evalPartsAt(self, x, parts, key=None, following=[]):
+        if key is None:
+            key = self.pointKey(x)
+        pool = self.pool()
+        if pool is None or len(parts) < 2:
+            for (i, p) in enumerate(parts):
+                if self.prefetcher is not None:
+                    self.prefetchAhead(parts[i+1:] + following)
+                    self.prefetcher.wait(p)
+                self.evalPart(x, p, key)
+            return
+        
+        if self.prefetcher is not None:
+            self.prefetchAhead(following)
+        
+        ranges = [self.partRange(p) for p in parts]
+        if self.executor == 'process':
+            # The workers only read it while the results are consumed below
+            self.sharedX[:] = x
+            results = pool.imap(_evalInWorker, ranges)
+        else:
+            results = pool.imap(lambda r: eval_range(self.f, x, r[0], r[1]), 
+                                ranges)
+        
+        for (i, (loss, g, intermediates)) in enumerate(results):
+            (s,e) = ranges[i]
+            self.pointsProcessed += (e-s)
+            self.storePart(x, parts[i], loss, g, intermediates, key)
 
     def __call__(self, x):
+        self.evaluations += 1
+        key = self.pointKey(x)
+        
+        # Reduction is always in part order, so the result does not depend
+        # on the executor used.
         loss = 0.0
         g = zeros(self.n)
-        for p in range(self.parts):
-            (lossp, gp) = self.evalPart(x, p)
-            loss += lossp
-            g += gp
+        for batch in self.batches(range(self.parts)):
+            self.evalParts(x, batch, key, range(batch[-1] + 1, self.parts))
+            for p in batch:
+                loss += self.losses[p]
+                g += self.partGrad(x, p, key)
+        self.prefetchDone()
         return (loss, g)
 
+    def directionalParts(self, x, d, parts):
+        """ Sums the losses and directional derivatives along d of the given
+            parts at x, using the directional(x, d, s, e) method of the 
+            objective. Nothing is cached, as no gradients are computed.
+            Parts are evaluated concurrently as in evalParts.
+        """
+        if self.timed:
+            start = time.time()
+        
+        ranges = [self.partRange(p) for p in parts]
+        pool = self.pool()
+        if pool is None or len(ranges) < 2:
+            results = (self.f.directional(x, d, s, e) for (s,e) in ranges)
+        elif self.executor == 'process':
+            self.sharedX[:] = x
+            self.sharedD[:] = d
+            results = pool.imap(_directionalInWorker, ranges)
+        else:
+            results = pool.imap(lambda r: self.f.directional(x, d, r[0], r[1]),
+                                ranges)
+        
+        loss = 0.0
+        dloss = 0.0
+        for (i, (lossp, dlossp)) in enumerate(results):
+            (s,e) = ranges[i]
+            self.pointsProcessed += (e-s)
+            loss += lossp
+            dloss += dlossp
+        
+        if self.timed:
+            self.evaluationTime += time.time() - start
+        return (loss, dloss)
+
+    def prefetchTimes(self):
+        """ Seconds spent prefetching, and waiting for prefetches """
+        if self.prefetcher is None:
+            return (0.0, 0.0)
+        return (self.prefetcher.time, self.prefetcher.waitTime)
+
+    def directional(self, x, d):
+        """ The loss at x and its directional derivative along d. """
+        self.evaluations += 1
+        return self.directionalParts(x, d, range(self.parts))
+
+    def state(self):
+        """ The counters, keyed by name, for checkpointing. """
+        return {'pointsProcessed': self.pointsProcessed, 
+                'evaluations': self.evaluations,
+                'hessianProducts': self.hessianProducts,
+                'evaluationTime': self.evaluationTime,
+                'damping': self.damping}
+
+    def restore(self, state, x):
+        """ Restores a state returned by the state method, when resuming
+            at the point x. The dense gradient cache is refilled by 
+            evaluating at x, as the hessian-vector products assume it holds
+            the gradients there. The counters are restored afterwards, so 
+            this evaluation is not counted.
+        """
+        if self.grads is not None:
+            self.evalParts(x, self.checkpointParts())
+        self.pointsProcessed = int(state['pointsProcessed'])
+        self.evaluations = int(state['evaluations'])
+        self.hessianProducts = int(state['hessianProducts'])
+        self.evaluationTime = float(state['evaluationTime'])
+        self.damping = float(state['damping'])
+
+    def checkpointParts(self):
+        """ The parts whose gradients are in use between iterations """
+        return range(self.parts)
+
+    def saveCache(self):
+        """ Copies of the cached losses and gradients of the parts in use,
+            for restoreCache. Evaluating a trial point overwrites them,
+            while finite difference products at the current point assume
+            they hold its gradients. Only the dense cache needs this, as
+            the lru cache is keyed by point, so None is returned otherwise.
+            The copy is of the subset's rows of the cache, which costs far
+            less than evaluating the current point again.
+        """
+        if self.grads is None:
+            return None
+        parts = list(self.checkpointParts())
+        return (parts, self.losses[parts], self.grads[parts, :])
+
+    def restoreCache(self, saved):
+        """ Restores the cache as it was when saveCache returned saved """
+        if saved is not None:
+            (parts, losses, grads) = saved
+            self.losses[parts] = losses
+            self.grads[parts, :] = grads
+
     def evalRandom(self, x):
-        p = random.randint(0, self.parts)
+        p = self.random.randint(0, self.parts)
         return self.evalPart(x, p)
 
+    def samplePart(self):
+        return self.random.randint(0, self.parts)
+
     def make_mv_rand(self, x):
-        p = random.randint(0, self.parts)
-        return self.make_hv(x, p)
+        return self.damped(self.make_hv(x, self.samplePart()))
+
+    def make_mv_rand_block(self, x):
+        return self.damped(self.make_hv_block(x, self.samplePart()))
+
+    def damped(self, mv):
+        """ mv with damping*v added to each product, when damping is set.
+            The damping is read when each product is made.
+        """
+        def dampedMv(v):
+            hv = mv(v)
+            if self.damping > 0:
+                hv = hv + self.damping*v
+            return hv
+        return dampedMv
+
+    def intermediates(self, x, p):
+        """ Keyword arguments passing any intermediates cached from 
+            evaluating part p at x on to gaussNewtonProd.
+        """
+        if self.cacheIntermediates:
+            return {'cache': self.partCache.get(p, fingerprint(x))}
+        else:
+            return {}
 
     def make_hv(self, x, p):
         """ This returns a function that acts as a hessian vector product.
@@ -69,32 +588,78 @@ class Objective(object):
             part p was at location x.
         """
         
-        right_grad = self.grads[p, :]
         (s,e) = self.partRange(p)
-        
-        # fdEps needs to e scaled so its much smaller than the gradient's
-        # entry wise magnitude.
-        fdEps = linalg.norm(right_grad, inf) * self.props.get("fdEps", 1e-8)
         scale = self.ndata / float(e-s)
         
         # Use GaussNewton if implemented by them
         if hasattr(self.f, 'gaussNewtonProd'):
+            kwargs = self.intermediates(x, p)
             def mv(v):
+                self.hessianProducts += 1
                 self.pointsProcessed += (e-s) # Handled in evalRange otherwise
-                return scale*self.f.gaussNewtonProd(x, v, s, e)
+                hvp = scale*self.f.gaussNewtonProd(x, v, s, e, **kwargs)
+                return hvp.astype(self.dtype, copy=False)
         else:
+            right_grad = self.partGrad(x, p)
+            
+            # fdEps needs to e scaled so its much smaller than the gradient's
+            # entry wise magnitude.
+            fdEps = linalg.norm(right_grad, inf) * self.fdEps
             def mv(v):
+                self.hessianProducts += 1
                 _, left_grad = self.evalRange(x + fdEps*v, s, e)
                 hvp = (left_grad - right_grad) / fdEps
-                return scale*hvp
+                return (scale*hvp).astype(self.dtype, copy=False)
             
         return mv
+
+    def diagonal(self, x, p):
+        """ The diagonal of the Gauss-Newton matrix over part p at x, 
+            scaled as in make_hv, from the objective's 
+            gaussNewtonDiag(x, s, e) method.
+        """
+        (s,e) = self.partRange(p)
+        self.pointsProcessed += (e-s)
+        kwargs = self.intermediates(x, p)
+        scale = self.ndata / float(e-s)
+        return scale*self.f.gaussNewtonDiag(x, s, e, **kwargs)
+
+    def make_hv_block(self, x, p):
+        """ As make_hv, but the returned function multiplies a block of 
+            vectors, stacked as the columns of an n x k matrix, returning
+            an n x k matrix. If the objective provides a
+            gaussNewtonProdBlock(x, V, s, e) method, the whole block is
+            handled in one call, otherwise the columns are multiplied in turn.
+        """
+        (s,e) = self.partRange(p)
+        scale = self.ndata / float(e-s)
+        
+        if hasattr(self.f, 'gaussNewtonProdBlock'):
+            kwargs = self.intermediates(x, p)
+            def mv(V):
+                self.hessianProducts += V.shape[1]
+                self.pointsProcessed += V.shape[1]*(e-s)
+                HV = scale*self.f.gaussNewtonProdBlock(x, V, s, e, **kwargs)
+                return HV.astype(self.dtype, copy=False)
+        else:
+            mvSingle = self.make_hv(x, p)
+            def mv(V):
+                HV = empty(V.shape, dtype=self.dtype)
+                for j in range(V.shape[1]):
+                    HV[:, j] = mvSingle(V[:, j])
+                return HV
+        
+        return mv
         
         
 class SubsetObjective(Objective):
     def __init__(self, f, ndata, n, props={}):
         self.currentSubsetParts = 0
         self.errBound = props.get("gradRelErrorBound", 0.1)
+        
+        # RunningSums over the current subset from the last onCurrentSubset
+        # call, with a copy of the point, for use when expanding.
+        self.subsetSums = None
         super(SubsetObjective,self).__init__(f, ndata, n, props)
 
     def onCurrentSubset(self, x):
@@ -102,61 +667,93 @@ class SubsetObjective(Objective):
             Unlike the __call__ method, this does not expand
             the active subset
         """
-        loss = 0.0
-        g = zeros(self.n)
-        for p in range(self.currentSubsetParts):
-            (lossp, gp) = self.evalPart(x, p)
-            loss += lossp
-            g += gp
+        self.evaluations += 1
+        key = self.pointKey(x)
         
-        scale = self.ndata/float(self.partRange(p)[1])
-        return (loss*scale, g*scale)
+        sums = RunningSums(self.n)
+        for batch in self.batches(range(self.currentSubsetParts)):
+            self.evalParts(x, batch, key, 
+                           range(batch[-1] + 1, self.currentSubsetParts))
+            for p in batch:
+                sums.add(self.losses[p], self.partGrad(x, p, key))
+        self.prefetchDone()
+        self.subsetSums = (array(x, copy=True), sums.copy())
+        
+        scale = self.ndata/float(self.partRange(self.currentSubsetParts-1)[1])
+        return (sums.loss*scale, sums.g*scale)
+
+    def state(self):
+        state = super(SubsetObjective, self).state()
+        state['currentSubsetParts'] = self.currentSubsetParts
+        return state
+
+    def restore(self, state, x):
+        self.currentSubsetParts = int(state['currentSubsetParts'])
+        super(SubsetObjective, self).restore(state, x)
+
+    def checkpointParts(self):
+        return range(self.currentSubsetParts)
+
+    def directionalOnCurrentSubset(self, x, d):
+        """ As onCurrentSubset, but only the loss and directional 
+            derivative along d are computed.
+        """
+        self.evaluations += 1
+        (loss, dloss) = self.directionalParts(x, d, 
+                                              range(self.currentSubsetParts))
+        scale = self.ndata/float(self.partRange(self.currentSubsetParts-1)[1])
+        return (loss*scale, dloss*scale)
 
     def __call__(self, x, expand=False):
         """
             Evaluates the function on a enough parts to
             satisfy the relative error condition.
-            If expand=True, it assumes that self.losses/grads contains
-            the correct values at the current points for parts under currentSubsetParts
+            If expand=True, the parts under currentSubsetParts are not 
+            evaluated again if the last call to onCurrentSubset was at x,
+            their sums from that call are used instead.
+            
+            When a parallel executor is used, parts are evaluated in batches
+            of one per worker, so a few parts past the stopping point may be
+            evaluated (and counted in pointsProcessed). The returned values
+            are identical to the serial case.
         """
-        loss = 0.0
+        self.evaluations += 1
+        key = self.pointKey(x)
         standardErr = 0.0
-        g = zeros(self.n)
-        for p in range(self.parts):
-            if expand and p < self.currentSubsetParts:
-                lossp = self.losses[p]
-                gp = self.grads[p,:]
+        
+        sums = None
+        if expand and self.subsetSums is not None:
+            (subsetX, subsetSums) = self.subsetSums
+            if (array_equal(subsetX, x) and 
+                subsetSums.count == self.currentSubsetParts):
+                sums = subsetSums.copy()
             else:
-                (lossp, gp) = self.evalPart(x, p)
-            loss += lossp
-            g += gp
+                self.logger.debug("Subset sums are not for this point, "
+                                  "evaluating the subset again")
+        if sums is None:
+            sums = RunningSums(self.n)
+        
+        p = sums.count - 1
+        batchEnd = sums.count
+        for p in range(sums.count, self.parts):
+            if p >= batchEnd:
+                batchEnd = min(p + self.batchSize, self.parts)
+                self.evalParts(x, range(p, batchEnd), key, 
+                               range(batchEnd, self.parts))
+            sums.add(self.losses[p], self.partGrad(x, p, key))
             
             if p >= self.currentSubsetParts:
-                gavg = g/(p+1)
-                gavgnorm = linalg.norm(gavg)
-                fvalAvg = loss/(p+1)
-            
-                fvalSumSq = 0.0
-                sumSq = 0.0
-                mindev = inf
-                maxdev = -inf
-                for j in range(p+1):
-                    dev = linalg.norm(self.grads[j,:] - gavg)
-                    sumSq += pow(dev/((p+1)*gavgnorm), 2.0)
-                    fvalSumSq += pow((self.losses[j]-fvalAvg)/(p+1), 2.0)
-                    
-                    mindev = min(dev, mindev)
-                    maxdev = max(dev, maxdev)
-                    errAvg = sqrt(sumSq)
+                gavgnorm = linalg.norm(sums.g/(p+1))
+                errAvg = sqrt(max(sums.devSumSq, 0.0))/((p+1)*gavgnorm)
                 
                 # Finite sample correction
                 standardErr = errAvg * sqrt((self.parts-p-1.0)/(self.parts-1.0)) 
-                fvalSE = fvalSumSq * sqrt((self.parts-p-1.0)/(self.parts-1.0))
                 fraction = (p+1)/float(self.parts)
 
                 if (standardErr < self.errBound and 
                    fraction <= 0.8 and fraction >= 0.05 and p >= 4):
                     break
+        self.prefetchDone()
                 
         self.currentSubsetParts = p + 1
         scale = self.ndata/float(self.partRange(p)[1])
@@ -164,9 +761,8 @@ class SubsetObjective(Objective):
         self.logger.debug("For objective eval used %d/%d of data (se: %1.2f)",
             self.currentSubsetParts, self.parts, standardErr)
                 
-        return (loss*scale, g*scale)
+        return (sums.loss*scale, sums.g*scale)
 
-    def make_mv_rand(self, x):
-        p = random.randint(0, self.currentSubsetParts)
-        return self.make_hv(x, p)
+    def samplePart(self):
+        return self.random.randint(0, self.currentSubsetParts)
     
@@ -12,9 +12,14 @@ import numpy
 import linesearch
 import innersolve
 import objective
+import checkpoint
+# Renamed, as the star import of numpy below would rebind diagonal
+import diagonal as diagonal_estimate
+from stats import IterationStats
 from numpy import *
 
-def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
+def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={},
+             resume=None):
     """
     This method can be invoked in a simlar way as lbfgs routines in Scipy,
     with the following differences:
@@ -43,6 +48,13 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
         useful for tracking progress for latter plotting. 
         PlottingCallback in the convergence module can do
         this for you.
+    :keyword string resume:
+        A checkpoint file written during an earlier run (see the 
+        **checkpoint** property). The run continues from the iteration
+        it was saved at, taking the same steps as the original run, 
+        provided f, ndata and props are unchanged. maxiter counts the 
+        iterations of the original run, and x0 is ignored. The callback 
+        is not invoked for the initial point.
     :keyword object props:
         Map of additional parameters:
          - **parts** (*integer* default 100)
@@ -66,6 +78,10 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
             works much better than cg. If the condition number of the hessian
             is very large however, cg is the better option. In those cases
             the solveFraction property should normally be increases as well.
+            Setting this to 'pcg' uses conjugate gradient preconditioned by 
+            the lbfgs approximation to the inverse hessian, with early 
+            termination, which converges in fewer steps than cg when the 
+            hessian is badly conditioned.
          - **solveFraction** (*float* default 0.2)
             The cg or lbfgs linear solvers perform a number of iterations
             such that **solveFraction** fraction of overhead is incurred.
@@ -86,13 +102,42 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
             this threshold. 0.1 is conservative; better results may be 
             achieved by using values up to about 0.4. Larger values may cause
             erratic convergence behavior though.
+         - **expandSubset** (*boolean* default False)
+            The line search evaluates trial points on the current subset 
+            only. If set, the subset is expanded at the accepted point until 
+            the **gradRelErrorBound** holds. The sums over the current 
+            subset are reused from the accepted trial evaluation, so only 
+            the added parts are evaluated.
          - **lbfgsMemory** (*integer* 10)
             The lbfgs search direction is used as the initial guess at the 
             search direction for the cg and lbfgs inner solves. This controls
             the memory used for that. The same memory is used for the inner 
             lbfgs solve. Changing this has less of an effect than it would
             on a standard lbfgs implementation.
-         - **fdEps** (*float* default 1e-8)
+         - **lbfgsStepVariant** (*string* default 'twoloop')
+            How lbfgs steps are computed from the stored curvature pairs.
+            'twoloop' is the standard two-loop recursion. 'compact' uses the
+            compact matrix representation, which replaces the loops with two 
+            matrix-vector products against the whole history. It is faster 
+            for large numbers of parameters, at the cost of maintaining 
+            the inner products between the stored pairs.
+         - **diagonal** (*boolean* default False)
+            Maintains an estimate of the diagonal of the hessian, updated 
+            each iteration on one part, and uses it as the initial matrix 
+            of the lbfgs approximation in place of a scaled identity. This
+            helps on badly scaled problems. The estimate comes from the 
+            objective's gaussNewtonDiag(x, s, e) method if it has one, and 
+            from random hessian-vector products otherwise. With this set, 
+            lbfgs steps always use the two-loop recursion. If a step made
+            with the estimate is not a descent direction, the plain lbfgs 
+            step is used instead. See :mod:`phessianfree.diagonal`.
+         - **diagonalProbes** (*integer* default 10)
+            Hessian-vector products used per update of the diagonal 
+            estimate, when it is estimated from products.
+         - **diagonalDecay** (*float* default 0.9)
+            Weight given to the previous diagonal estimate in each update.
+         - **fdEps** (*float* default 1e-8, or the square root of machine 
+           epsilon when **dtype** is not float64)
             Unless a gaussNewtonProd method is implemented, hessian vector
             products are computed by using finite differences. Unlike 
             applying finite differences to approximate the gradient, the FD
@@ -101,6 +146,34 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
             If convergence plots become erratic near the optimum, tuning this
             parameter can help. This normally occurs long after the test loss
             has plateaued however.
+         - **cgWarmStart** (*float* default 0)
+            If positive, the cg and pcg subsetVariants start from the 
+            previous outer iteration's search direction multiplied by this
+            (0.95 is typical), rather than from the lbfgs step.
+         - **cgBacktrack** (*boolean* default False)
+            The cg and pcg subsetVariants keep the iterates at steps 
+            ceil(1.3^j), that is 1, 2, 3, 4, 5, 7, 9, 11, 14, 18, ..., and
+            return the one with the lowest objective on the current 
+            subset, evaluating them from the last backwards until the 
+            value increases. This guards against cg overshooting when the
+            quadratic model is a poor fit, but is expensive: each kept 
+            iterate tried costs a full evaluation of the current subset, 
+            so an iteration may process several times as many datapoints 
+            as without it. These evaluations are counted in the 
+            innerSolveEvaluations statistic.
+         - **pcgPreconditioner** (*string* default 'lbfgs')
+            Preconditioner used by the pcg subsetVariant. 'lbfgs' uses the 
+            stored curvature pairs, 'none' gives unpreconditioned cg with 
+            the early termination rules below.
+            'jacobi' uses the diagonal estimate, when the **diagonal** 
+            property is set.
+         - **pcgTol** (*float* default 1e-10)
+            pcg stops once the residual norm is below this fraction of the
+            gradient norm.
+         - **pcgProgressTol** (*float* default 5e-4)
+            pcg stops once the quadratic model's relative decrease over the
+            last j = max(10, i/10) of its i steps falls below j times this 
+            (the criterion of Martens 2010). Setting it to 0 disables this.
          - **innerSolveAverage** (*boolean* default False)
             Applicable only if subsetVariant is lbfgs, this turns on the 
             use of 50% sequence suffix averaging for the inner solve.
@@ -113,8 +186,95 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
             Doing an exact line search makes overconfident steps however, and
             so the step is scaled by this factor. If the lbfgs linear solve
             is diverging, decrease this.
+         - **parallel** (*string* default None)
+            Setting this to 'thread' or 'process' evaluates the parts of
+            a gradient concurrently. Use 'thread' when your objective spends
+            most of its time in numpy routines that release the GIL, and
+            'process' for objectives written in pure python. With 'process',
+            your objective is copied into each worker when the pool starts,
+            so it should not rely on state modified after that point, and 
+            the point is passed to the workers through shared memory. 
+            Results are identical to the serial evaluation.
+         - **workers** (*integer* default number of cpus)
+            Size of the worker pool used when **parallel** is set.
+         - **dtype** (*numpy dtype* default float64)
+            Precision used to store the cached gradient of each part, the
+            lbfgs curvature pairs and hessian-vector products. Setting 
+            this to float32 halves the memory used by these, which for 
+            large models is dominated by the parts x n gradient cache. 
+            Gradients, losses and inner products are still accumulated in 
+            float64. See benchmarks/precision.py for the effect on 
+            convergence.
+         - **directionalLineSearch** (*boolean* default False)
+            If set and the objective has a directional(x, p, s, e) method,
+            returning the loss over (s,e) and its directional derivative 
+            along p, line search trial points are evaluated with it instead
+            of computing gradients. The gradient is then computed only at 
+            the accepted point, costing one extra pass over the subset, so
+            this helps when the directional derivative is much cheaper 
+            than the gradient or line searches often need several trials.
+         - **gradCache** (*string* default 'dense')
+            How the gradient of each part is kept for reuse. 'dense' keeps 
+            all of them, in a parts x n array. 'lru' keeps only those of the 
+            **gradCacheParts** most recently evaluated parts, along with 
+            the point they were evaluated at, so memory use is O(n) rather 
+            than O(parts n). Subset gradient statistics are accumulated as 
+            parts are evaluated, so nothing else needs the per-part 
+            gradients, except finite difference hessian-vector products, 
+            which evaluate the part again if its gradient is not held.
+         - **gradCacheParts** (*integer* default 10)
+            Number of part gradients held when **gradCache** is 'lru'. At 
+            least one per worker is always held.
+         - **prefetchDepth** (*integer* default 0)
+            If positive and **f** has a prefetch(s, e) method, it is called
+            on a background thread for up to this many parts ahead of the
+            part being evaluated, when the order parts will be evaluated in
+            is known. This lets data loading or staging overlap evaluation.
+            The time spent prefetching, and waiting for prefetches, is 
+            recorded in the iteration statistics.
+         - **checkpoint** (*string* default None)
+            File to save the optimizer state to, for continuing the run 
+            later with the resume argument. The file is replaced 
+            atomically, and written on a background thread. See 
+            :mod:`phessianfree.checkpoint`.
+         - **checkpointEvery** (*integer* default 1)
+            Number of outer iterations between checkpoints.
+         - **stepControl** (*string* default 'linesearch')
+            How the step along the search direction is chosen. 
+            'linesearch' uses a strong Wolfe line search. 'damping' instead
+            adds a Levenberg-Marquardt damping term to the hessian-vector 
+            products used by the inner solve, and tries the full step with
+            a single evaluation, accepting it if the objective decreases.
+            The damping is increased or decreased depending on how well 
+            the quadratic model predicted the reduction, as in Martens 
+            (2010). This is more robust on non-convex objectives, where 
+            line searches may fail, and needs fewer evaluations per step.
+            The cg inner solvers are the natural choice with damping.
+         - **initialDamping** (*float* default 1.0)
+            Initial damping when **stepControl** is 'damping', on the 
+            scale of the hessian of the whole objective.
+         - **dampingIncrease** (*float* default 1.5)
+            Factor the damping is multiplied by when the reduction ratio 
+            is below 1/4.
+         - **dampingDecrease** (*float* default 2/3)
+            Factor the damping is multiplied by when the reduction ratio 
+            is above 3/4.
+         - **seed** (*integer or RandomState* default None)
+            Seeds the random number generator used for all random choices
+            made by the optimizer, such as the parts sampled for 
+            hessian-vector products. Runs with the same seed and props 
+            are reproducible, whether or not a parallel executor is used,
+            as all sampling happens in the calling process. If None, 
+            numpy's global random state is used.
+         - **collectStats** (*boolean* default False)
+            Collects an :class:`~phessianfree.stats.IterationStats` for each
+            outer iteration, recording timings, the number of line search
+            evaluations and hessian-vector products, and so on. It is 
+            passed to the callback as a fifth argument (None for the 
+            initial point), and the list of them for the run is returned 
+            as a third value.
         
-    :rtype: (xk, fval)
+    :rtype: (xk, fval), or (xk, fval, stats) if collectStats is set
        
     .. note::
         If your objective is non-convex, you need to explictly provide a 
@@ -125,64 +285,128 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
         method that implements the matrix vector product against v for
         the GN approximation at x over the datapoints (s,e). This is
         illustrated in the autoencoder example code.
+        A gaussNewtonProdBlock(x, V, s, e) method may also be provided, 
+        which multiplies each column of the n x k matrix V in one call,
+        for when several independent products are needed at once.
+        
+        If computing gaussNewtonProd at x repeats work done when evaluating 
+        the objective at x (such as computing activations or margins), **f**
+        can also implement evalCached(x, s, e), returning 
+        (loss, gradient, intermediates). The intermediates from the most 
+        recent evaluation of each part are kept, and passed back as 
+        gaussNewtonProd(x, v, s, e, cache=intermediates) when the product 
+        is at the same x, or cache=None otherwise. The **cacheParts** 
+        property (default all parts) limits how many parts' intermediates 
+        are kept, dropping the least recently used.
+        
+        **f** may also be an already constructed Objective, such as a 
+        :class:`~phessianfree.distributed.DistributedObjective`, in which 
+        case it is used directly and the **subsetObjective** property is 
+        ignored.
         
     
     """
-    logger = logging.getLogger("phf")
     useSubsetObjective = props.get("subsetObjective", True)
     n = len(x0)
     
-    if useSubsetObjective:
+    # Already wrapped objectives (such as a DistributedObjective) are 
+    # used as is, and left open for reuse
+    wrapped = not isinstance(f, objective.Objective)
+    if wrapped and useSubsetObjective:
         f = objective.SubsetObjective(f, ndata, n, props)
-    else:
+    elif wrapped:
         f = objective.Objective(f, ndata, n, props)
     
     x0 = asarray(x0).squeeze()
     if x0.ndim == 0:
         x0.shape = (1,)
     
-    (fval, gfk) = f(x0)
-    gfkp1 = None
+    try:
+        return _optimize(f, x0, ndata, gtol, maxiter, callback, props, resume)
+    finally:
+        if wrapped:
+            f.close()
+
+def _optimize(f, x0, ndata, gtol, maxiter, callback, props, resume):
+    logger = logging.getLogger("phf")
     
-    if callback is not None:
-        callback(x0, fval, gfk, f.pointsProcessed)
+    collectStats = props.get("collectStats", False)
+    useDiagonal = props.get("diagonal", False)
     
-    if isinf(fval):
-        raise Exception("X0 fval is infinite")
+    if props.get("stepControl", 'linesearch') == 'linesearch':
+        stepControl = linesearch.strong_wolfe
+    elif props.get("stepControl") == 'damping':
+        stepControl = linesearch.damped_step
+        if resume is None:
+            f.damping = props.get("initialDamping", 1.0)
+    else:
+        raise Exception("invalid step control configured")
+    compact = props.get("lbfgsStepVariant", 'twoloop') == 'compact'
+    memory = innersolve.LbfgsMemory(props.get("lbfgsMemory", 10), len(x0), 
+                                    compact, f.dtype)
     
-    k = 0  
-    xk = x0
+    if resume is not None:
+        state = checkpoint.load(resume)
+        (k, xk, fval, gfk, history) = checkpoint.restore(state, memory, f)
+        logger.info("Resumed from %s at iteration %d", resume, k)
+    else:
+        (fval, gfk) = f(x0)
+        
+        if callback is not None:
+            if collectStats:
+                callback(x0, fval, gfk, f.pointsProcessed, None)
+            else:
+                callback(x0, fval, gfk, f.pointsProcessed)
+        
+        if isinf(fval):
+            raise Exception("X0 fval is infinite")
+        
+        k = 0  
+        xk = x0
+        history = []
 
     gnorm = linalg.norm(gfk)
     logger.info("Initial fval: %1.8f, gnorm %2.2e", fval, gnorm)
-
-    vecs = {}
+    
+    # Checkpoints are written on a background thread, which is waited 
+    # for before returning
+    writer = None
+    if props.get("checkpoint", None) is not None:
+        writer = checkpoint.Writer(props["checkpoint"])
+        checkpointEvery = props.get("checkpointEvery", 1)
     
     while (gnorm > gtol) and (k < maxiter):
+        if collectStats:
+            stats = IterationStats(k)
+            stats.start(f, memory)
+        
+        if useDiagonal:
+            diagonal_estimate.update(f, xk, memory, props)
                     
-        pk = innersolve.solve(f, xk, gfk, k, vecs, props)
+        pk = innersolve.solve(f, xk, gfk, k, memory, props)
+        if collectStats:
+            stats.solved(f)
         
         ###### Line search
-        (alpha_k, fval, gfkp1) = linesearch.strong_wolfe(f, xk, fval, gfk, pk, props)
+        (alpha_k, fval, gfkp1) = stepControl(f, xk, fval, gfk, pk, props)
+        if collectStats:
+            stats.searched()
             
         previous_fval = fval
-        xkp1 = xk + alpha_k * pk
-        sk = xkp1 - xk
-        xk = xkp1
-        yk = gfkp1 - gfk
-        
-        skyk = dot(sk, yk)
-        rhok = 1.0 / skyk
-        
-        if len(vecs) == 0:
-            kmax = 0
-        else:
-            kmax = numpy.max(vecs.keys())+1
-        
-        if skyk <= 0:
-            logger.error("BAD CURVATURE skyk=%1.1e !!!!!!!!!!", skyk)
-        else:
-            vecs[kmax] = (sk, yk, rhok)
+        if alpha_k > 0:
+            xkp1 = xk + alpha_k * pk
+            sk = xkp1 - xk
+            xk = xkp1
+            yk = gfkp1 - gfk
+            
+            skyk = dot(sk, yk)
+            rhok = 1.0 / skyk
+            
+            if skyk <= 0:
+                logger.error("BAD CURVATURE skyk=%1.1e !!!!!!!!!!", skyk)
+                memory.rejections += 1
+            else:
+                memory.append(sk, yk, rhok)
         
         gnorm = linalg.norm(gfkp1)
         gfk = gfkp1
@@ -190,9 +414,28 @@ def optimize(f, x0, ndata, gtol=1e-5, maxiter=100, callback=None, props={}):
         logger.info(" Iteration %d, fval: %1.8f, gnorm %1.3e, effective iters: %1.2f", 
                     k, fval, gnorm, f.pointsProcessed/float(ndata)) 
         
+        if collectStats:
+            stats.stepSize = alpha_k
+            stats.finish(f, memory)
+            history.append(stats)
+            logger.debug("%s", stats)
+        
         if callback is not None:
-            callback(xk, fval, gfk, f.pointsProcessed)
+            if collectStats:
+                callback(xk, fval, gfk, f.pointsProcessed, stats)
+            else:
+                callback(xk, fval, gfk, f.pointsProcessed)
         
         k += 1
+        
+        if writer is not None and k % checkpointEvery == 0:
+            writer.write(checkpoint.snapshot(k, xk, fval, gfk, memory, f, 
+                                             history))
 
-    return xk, fval
+    if writer is not None:
+        writer.wait()
+    
+    if collectStats:
+        return xk, fval, history
+    else:
+        return xk, fval
@@ -0,0 +1,127 @@
+"""
+.. module:: sgd
+    :platform: Unix, Windows
+    :synopsis: Minibatch stochastic gradient descent, using the same objective interface as optimize
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+"""
+
+import logging
+import objective
+from numpy import *
+
+def sgd(f, x0, ndata, maxiter=100, callback=None, props={}):
+    """
+    Minibatch stochastic gradient descent, where each minibatch is one of
+    the parts used by :func:`phessianfree.optimize`. It takes the same
+    objective function, and reports progress in the same way, so the two
+    can be compared directly.
+
+    :param function f:
+        Objective function, taking arguments (x,s,e), where
+        (s,e) is the range of datapoints over which to evaluate
+        the objective.
+    :param vector x0:
+        Initial point
+    :param int ndata:
+        Number of points in dataset. The passed function
+        will be invoked with s,e between 0 and ndata.
+
+    :keyword int maxiter:
+        Number of passes over the data (epochs) to make.
+    :keyword function callback:
+        Invoked at the end of each epoch with (xk, fval, gfk, pointsProcessed).
+        As SGD never evaluates the full objective, fval and gfk are the sums
+        of the most recent loss and gradient seen for each part, which are
+        evaluated at different points over the epoch.
+    :keyword object props:
+        Map of additional parameters:
+         - **parts** (*integer* default 100)
+            The data is split into this many minibatches, in the same way
+            as for optimize.
+         - **SGDInitialStep** (*float* default 1.0)
+            Step size used for the first step. Each minibatch gradient is
+            rescaled to estimate the full gradient before it is applied.
+         - **SGDStepScale** (*float* default 0.1)
+            The step size is decreased as
+            SGDInitialStep/(1 + SGDStepScale*t), where t is the number
+            of epochs completed so far, counted fractionally.
+         - **SGDMomentum** (*float* default 0.0)
+            Heavy ball momentum coefficient. 0 disables momentum.
+         - **SGDAverage** (*boolean* default False)
+            Use Polyak averaging, where the average of all iterates is
+            reported and returned instead of the last one.
+         - **seed** (*integer or RandomState* default None)
+            Seeds the order minibatches are visited in each epoch, as for
+            optimize.
+
+    :rtype: (xk, fval)
+    """
+    logger = logging.getLogger("phf.sgd")
+    initialStep = props.get("SGDInitialStep", 1.0)
+    stepScale = props.get("SGDStepScale", 0.1)
+    momentum = props.get("SGDMomentum", 0.0)
+    average = props.get("SGDAverage", False)
+    n = len(x0)
+
+    # Gradients are used once and never cached, so the dense parts x n 
+    # gradient cache is not allocated.
+    f = objective.Objective(f, ndata, n, dict(props, gradCache='lru'))
+
+    xk = array(x0, dtype=float64).squeeze()
+    if xk.ndim == 0:
+        xk.shape = (1,)
+
+    # All updates are made in place, using these preallocated buffers
+    step = zeros(n)
+    if momentum > 0:
+        velocity = zeros(n)
+    if average:
+        xavg = xk.copy()
+
+    k = 0
+    fval = inf
+    try:
+        for epoch in range(maxiter):
+            # Each part is visited once per epoch, so these sum to the 
+            # loss and gradient seen over the epoch.
+            fval = 0.0
+            gfk = zeros(n)
+            for p in f.random.permutation(f.parts):
+                (s,e) = f.partRange(p)
+                (lossp, g) = f.evalRange(xk, s, e)
+                fval += lossp
+                gfk += g
+
+                t = k/float(f.parts)
+                stepSize = (ndata/float(e-s)) * initialStep/(1.0 + stepScale*t)
+                multiply(g, -stepSize, out=step)
+
+                if momentum > 0:
+                    velocity *= momentum
+                    velocity += step
+                    xk += velocity
+                else:
+                    xk += step
+                k += 1
+
+                if average:
+                    subtract(xk, xavg, out=step)
+                    step *= 1.0/(k+1)
+                    xavg += step
+
+            xreport = xavg if average else xk
+
+            logger.info(" Epoch %d, fval: %1.8f, gnorm %1.3e, effective iters: %1.2f",
+                        epoch, fval, linalg.norm(gfk), f.pointsProcessed/float(ndata))
+
+            if callback is not None:
+                callback(xreport.copy(), fval, gfk, f.pointsProcessed)
+    finally:
+        f.close()
+
+    if average:
+        return xavg, fval
+    else:
+        return xk, fval
@@ -0,0 +1,103 @@
+"""
+.. module:: stats
+    :platform: Unix, Windows
+    :synopsis: Per-iteration statistics collected by optimize
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+"""
+
+import time
+
+class IterationStats(object):
+    """
+    Work done during one outer iteration of optimize, collected when the
+    **collectStats** property is set.
+
+    :ivar int iteration: Outer iteration number, starting at 0.
+    :ivar float innerSolveTime: Seconds spent computing the search direction.
+    :ivar float lineSearchTime: Seconds spent in the line search.
+    :ivar float evaluationTime: Seconds spent evaluating the objective and
+        its gradient. This overlaps with the two times above.
+    :ivar int lineSearchEvaluations: Number of objective evaluations (over
+        the whole subset) made by the line search.
+    :ivar int innerSolveEvaluations: Number of objective evaluations made 
+        by the inner solve, when backtracking over cg iterates (see the 
+        **cgBacktrack** property).
+    :ivar int subsetParts: Number of parts in the subset used for gradients
+        at the end of the iteration.
+    :ivar int hessianProducts: Number of hessian-vector products made.
+    :ivar int curvatureRejections: Number of curvature pairs discarded for
+        not being positive, in both the inner solve and the outer update.
+    :ivar int pointsProcessed: Datapoints processed during the iteration.
+    :ivar float stepSize: Step size chosen by the line search.
+    :ivar float damping: Damping at the end of the iteration, when the 
+        **stepControl** property is 'damping', otherwise 0.
+    :ivar float prefetchTime: Seconds spent prefetching part data in the 
+        background (see the **prefetchDepth** property).
+    :ivar float prefetchWaitTime: Seconds evaluations spent waiting for
+        prefetches to finish. prefetchTime less this is the time overlapped 
+        with evaluation.
+    """
+
+    fields = ['iteration', 'innerSolveTime', 'lineSearchTime',
+              'evaluationTime', 'lineSearchEvaluations', 
+              'innerSolveEvaluations', 'subsetParts',
+              'hessianProducts', 'curvatureRejections', 'pointsProcessed',
+              'stepSize', 'damping', 'prefetchTime', 'prefetchWaitTime']
+
+    def __init__(self, iteration):
+        self.iteration = iteration
+        self.innerSolveTime = 0.0
+        self.lineSearchTime = 0.0
+        self.evaluationTime = 0.0
+        self.lineSearchEvaluations = 0
+        self.innerSolveEvaluations = 0
+        self.subsetParts = 0
+        self.hessianProducts = 0
+        self.curvatureRejections = 0
+        self.pointsProcessed = 0
+        self.stepSize = 0.0
+        self.damping = 0.0
+        self.prefetchTime = 0.0
+        self.prefetchWaitTime = 0.0
+
+    def start(self, f, memory):
+        """ Records the counters of objective f and lbfgs memory at the
+            start of the iteration.
+        """
+        self.started = (time.time(), f.evaluations, f.hessianProducts,
+                        f.evaluationTime, f.pointsProcessed, memory.rejections,
+                        f.prefetchTimes())
+
+    def solved(self, f):
+        self.solvedAt = time.time()
+        self.innerSolveTime = self.solvedAt - self.started[0]
+        self.innerSolveEvaluations = f.evaluations - self.started[1]
+
+    def searched(self):
+        self.lineSearchTime = time.time() - self.solvedAt
+
+    def finish(self, f, memory):
+        """ Sets the counts from the change in f and memory's counters """
+        (_, evaluations, products, evalTime, points, rejections, 
+         (prefetchTime, prefetchWaitTime)) = self.started
+        self.lineSearchEvaluations = (f.evaluations - evaluations - 
+                                      self.innerSolveEvaluations)
+        self.hessianProducts = f.hessianProducts - products
+        self.evaluationTime = f.evaluationTime - evalTime
+        self.pointsProcessed = f.pointsProcessed - points
+        self.curvatureRejections = memory.rejections - rejections
+        self.subsetParts = getattr(f, 'currentSubsetParts', f.parts)
+        self.damping = f.damping
+        (totalTime, totalWaitTime) = f.prefetchTimes()
+        self.prefetchTime = totalTime - prefetchTime
+        self.prefetchWaitTime = totalWaitTime - prefetchWaitTime
+        del self.started
+
+    def asdict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    def __repr__(self):
+        return "IterationStats(%s)" % ", ".join("%s=%r" % (name, getattr(self, name))
+                                               for name in self.fields)
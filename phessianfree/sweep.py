@@ -0,0 +1,339 @@
+"""
+.. module:: sweep
+    :platform: Unix
+    :synopsis: Runs optimize over many configurations concurrently, warm starting from finished runs
+
+
+.. moduleauthor:: Aaron Defazio <aaron.defazio@anu.edu.au>
+
+A sweep runs :func:`phessianfree.optimize` once for each of a list of
+configurations, such as a range of regularization values or props
+settings, on a pool of worker processes. Each configuration is a dict.
+Its **props** entry, if any, is passed to optimize, and every other entry
+is passed as a keyword argument to a factory that builds the objective,
+for example::
+
+    def factory(reg):
+        return glm.LogisticObjective(X, d, reg)
+
+    configs = [{'reg': reg, 'props': {'gradRelErrorBound': bound}}
+               for reg in [1e-2, 1e-3, 1e-4] for bound in [0.1, 0.3]]
+    results = sweep.sweep(factory, x0, ndata, configs)
+
+Workers are forked once and the factory is inherited rather than pickled,
+so a dataset loaded before calling sweep (ideally a memory mapped
+source from :mod:`phessianfree.data`) is shared by every worker, and
+closures and lambdas can be used as factories. Each worker keeps the
+objective built for each distinct set of factory arguments, so
+configurations differing only in props reuse the objective and any
+caches it holds.
+
+Runs are started in the order given. Each starts from the final point of
+the nearest already finished run, as measured by config_distance (or the
+distance argument), so ordering configurations along a path, such as
+decreasing regularization, gives the best warm starts.
+
+If a seed is given, each run gets its own **seed** property, drawn in
+order from a generator seeded with it (unless its props already set one),
+so runs sample independently of each other, and the same configuration
+samples identically however many workers are used. Warm starts do depend
+on the order runs finish in, so use warmStart=False or workers=1 where
+results must be exactly reproducible.
+"""
+
+import errno
+import logging
+import math
+import multiprocessing
+import os
+import Queue
+import time
+import traceback
+from numpy import *
+import optimize
+
+# Seconds between checks that the workers running configurations are alive
+POLL_INTERVAL = 1.0
+
+_workerRunner = None
+_workerPids = None
+
+def _initWorker(factory, pids):
+    global _workerRunner, _workerPids
+    _workerRunner = Runner(factory)
+    _workerPids = pids
+
+def _runInWorker(task):
+    # Recorded so the sweep notices if this process dies during the run
+    _workerPids[task[0]] = os.getpid()
+    return _workerRunner(task)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def factory_args(config):
+    """ The entries of config passed to the objective factory """
+    return dict((k, v) for (k, v) in config.items() if k != 'props')
+
+def flatten(config):
+    """ config with the entries of its props merged in """
+    flat = factory_args(config)
+    for (k, v) in config.get('props', {}).items():
+        flat['props.' + k] = v
+    return flat
+
+def seeded(config, seed):
+    """ config with its props' seed set, if not already """
+    props = dict(config.get('props', {}))
+    if props.get('seed', None) is not None:
+        return config
+    props['seed'] = seed
+    config = dict(config)
+    config['props'] = props
+    return config
+
+def config_distance(a, b):
+    """ Distance between two configurations, summed over their entries
+        (including props). Positive numbers are compared on a log scale,
+        other numbers by their difference, and anything else contributes
+        1 if the values differ. Entries present in only one of the
+        configurations also contribute 1. The seed property is ignored, as
+        it does not change the problem solved.
+    """
+    (a, b) = (flatten(a), flatten(b))
+    distance = 0.0
+    for key in (set(a) | set(b)) - set(['props.seed']):
+        if key not in a or key not in b:
+            distance += 1.0
+            continue
+        (u, v) = (a[key], b[key])
+        numeric = (isinstance(u, (int, long, float)) and
+                   isinstance(v, (int, long, float)) and
+                   not isinstance(u, bool) and not isinstance(v, bool))
+        if numeric and u > 0 and v > 0:
+            distance += abs(math.log(float(u)/v))
+        elif numeric:
+            distance += abs(u - v)
+        elif u != v:
+            distance += 1.0
+    return distance
+
+class SweepResult(object):
+    """
+    Outcome of one run of a sweep.
+
+    :ivar int index: Position of the configuration in the list passed to sweep.
+    :ivar dict config: The configuration.
+    :ivar vector x: Final point, or None if the run failed.
+    :ivar float fval: Final objective value, or None if the run failed.
+    :ivar int iterations: Outer iterations completed.
+    :ivar int pointsProcessed: Datapoints processed, excluding the initial
+        evaluation.
+    :ivar float time: Seconds taken by the run.
+    :ivar warmStart: Index of the run whose final point was used as the
+        starting point, or None if the given x0 was used.
+    :ivar error: Traceback of the exception raised by the run, or None.
+    :ivar list history: The :class:`~phessianfree.stats.IterationStats`
+        of each iteration.
+    """
+
+    fields = ['index', 'config', 'fval', 'iterations', 'pointsProcessed',
+              'time', 'warmStart', 'error']
+
+    def __init__(self, index, config, warmStart):
+        self.index = index
+        self.config = config
+        self.warmStart = warmStart
+        self.x = None
+        self.fval = None
+        self.iterations = 0
+        self.pointsProcessed = 0
+        self.time = 0.0
+        self.error = None
+        self.history = []
+
+    def finish(self, x, fval, history, elapsed, error):
+        self.x = x
+        self.fval = fval
+        self.history = history if history is not None else []
+        self.iterations = len(self.history)
+        self.pointsProcessed = sum(s.pointsProcessed for s in self.history)
+        self.time = elapsed
+        self.error = error
+
+    def asdict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    def __repr__(self):
+        return "SweepResult(%s)" % ", ".join("%s=%r" % (name, getattr(self, name))
+                                            for name in self.fields)
+
+def format_table(results):
+    """ The results of a sweep as a text table, one row per run """
+    lines = ["%5s %16s %6s %12s %9s %6s  %s" % ("index", "fval", "iters",
+             "points", "time", "warm", "config")]
+    for r in results:
+        fval = "failed" if r.error is not None else "%16.10f" % r.fval
+        warm = "-" if r.warmStart is None else str(r.warmStart)
+        lines.append("%5d %16s %6d %12d %9.2f %6s  %r" % (r.index, fval,
+            r.iterations, r.pointsProcessed, r.time, warm, r.config))
+    return "\n".join(lines)
+
+class Runner(object):
+    """ Runs the configurations handed to one process, keeping the
+        objective built for each distinct set of factory arguments.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.objectives = {}
+
+    def objectiveFor(self, config):
+        args = factory_args(config)
+        key = repr(sorted(args.items()))
+        if key not in self.objectives:
+            self.objectives[key] = self.factory(**args)
+        return self.objectives[key]
+
+    def __call__(self, task):
+        (index, config, x0, ndata, gtol, maxiter) = task
+        start = time.time()
+        try:
+            f = self.objectiveFor(config)
+            props = dict(config.get('props', {}), collectStats=True)
+            (x, fval, history) = optimize.optimize(f, x0, ndata, gtol=gtol,
+                maxiter=maxiter, props=props)
+            return (index, x, fval, history, time.time() - start, None)
+        except Exception:
+            return (index, None, None, None, time.time() - start,
+                    traceback.format_exc())
+
+def sweep(factory, x0, ndata, configs, gtol=1e-5, maxiter=100, workers=None,
+          warmStart=True, distance=config_distance, callback=None, seed=None):
+    """
+    Runs optimize for each configuration, returning a list of
+    :class:`SweepResult` in the same order as configs. Failed runs are
+    reported through the error attribute of their result rather than
+    raised, as are runs whose worker process dies (for example when 
+    killed for running out of memory).
+
+    :param function factory:
+        Called with the entries of a configuration other than props as
+        keyword arguments, returning the objective (as passed to optimize).
+    :param vector x0:
+        Initial point, used for runs with no finished run to warm start from.
+    :param int ndata:
+        Number of points in the dataset.
+    :param list configs:
+        The configurations, each a dict.
+
+    :keyword float gtol:
+        Passed to optimize for each run.
+    :keyword int maxiter:
+        Passed to optimize for each run.
+    :keyword int workers:
+        Number of worker processes, defaulting to the number of cpus. If 1,
+        the runs are made in this process instead.
+    :keyword boolean warmStart:
+        Start each run from the final point of the nearest finished run.
+    :keyword function distance:
+        Called with two configurations, returning the distance used to
+        choose the run to warm start from.
+    :keyword function callback:
+        Invoked with each SweepResult as its run finishes.
+    :keyword int seed:
+        Seeds the generator each run's seed property is drawn from.
+
+    :rtype: list of SweepResult
+    """
+    logger = logging.getLogger("phf.sweep")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(configs)))
+
+    if seed is not None:
+        seeds = random.RandomState(seed).randint(2**31 - 1, size=len(configs))
+        configs = [seeded(config, int(s)) for (config, s) in zip(configs, seeds)]
+
+    results = [None]*len(configs)
+    finished = []
+    pending = range(len(configs))
+    outstanding = set()
+    startedAt = {}
+    done = Queue.Queue()
+
+    if workers > 1:
+        # Pid of the worker running each configuration, 0 until started
+        pids = multiprocessing.Array('l', len(configs), lock=False)
+        pool = multiprocessing.Pool(workers, initializer=_initWorker,
+                                    initargs=(factory, pids))
+        runner = None
+    else:
+        pool = None
+        runner = Runner(factory)
+
+    def start(i):
+        source = None
+        if warmStart and len(finished) > 0:
+            source = min(finished, key=lambda j: distance(configs[i], configs[j]))
+        xstart = x0 if source is None else results[source].x
+        results[i] = SweepResult(i, configs[i], source)
+        startedAt[i] = time.time()
+        task = (i, configs[i], xstart, ndata, gtol, maxiter)
+        if pool is None:
+            done.put(runner(task))
+        else:
+            pool.apply_async(_runInWorker, (task,), callback=done.put)
+
+    def record(i, x, fval, history, elapsed, error):
+        results[i].finish(x, fval, history, elapsed, error)
+        if error is None:
+            finished.append(i)
+            logger.info("Run %d finished, fval %1.8f in %1.2fs",
+                        i, fval, elapsed)
+        else:
+            logger.error("Run %d failed:\n%s", i, error)
+
+        if callback is not None:
+            callback(results[i])
+
+    def lost():
+        """ Configurations whose worker process died while running them.
+            A killed worker never returns its result, so these are 
+            recorded as failed rather than waited for.
+        """
+        if pool is None:
+            return []
+        return [(i, None, None, None, time.time() - startedAt[i],
+                 "Worker process %d died while running this configuration"
+                 % pids[i])
+                for i in sorted(outstanding)
+                if pids[i] != 0 and not process_alive(pids[i])]
+
+    try:
+        while len(pending) > 0 or len(outstanding) > 0:
+            while len(pending) > 0 and len(outstanding) < workers:
+                i = pending.pop(0)
+                outstanding.add(i)
+                start(i)
+
+            try:
+                replies = [done.get(timeout=POLL_INTERVAL)]
+            except Queue.Empty:
+                replies = lost()
+
+            for (i, x, fval, history, elapsed, error) in replies:
+                # A result may still arrive from a worker that has since 
+                # died, after the run was recorded as failed
+                if i in outstanding:
+                    outstanding.remove(i)
+                    record(i, x, fval, history, elapsed, error)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return results